@@ -3,7 +3,12 @@ from apscheduler.triggers.combining import OrTrigger
 import datetime
 import pytz
 import pandas as pd
-from AlgoTrader.Util import is_trading_day, build_trigger
+import numpy as np
+from AlgoTrader.Util import is_trading_day, build_trigger, to_ns
+from AlgoTrader.Timeframe import parse_timeframe, MINUTE_NS
+
+DAY_NS = 24 * 3600 * 10**9
+OPEN_NS = (13 * 3600 + 30 * 60) * 10**9
 
 
 class Algo:
@@ -13,11 +18,13 @@ class Algo:
 		self.data = None
 		self.broker = None
 		self.next_runtime = None
+		self.indicators = []
 		self.set_schedule([{"second": "30", "minute": "30", "hour": "13", "day_of_week": "mon-fri"}])
 		self.init(*args, **kwargs)
 
 
 	def set_schedule(self, schedule):
+		self.schedule = schedule
 		self.trigger = build_trigger(schedule)
 
 
@@ -33,15 +40,62 @@ class Algo:
 		return self.data.quote(symbol=symbol, time=self.datetime)
 
 
-	def get_data(self, symbol, datatype, length):
-		data = self.data.get(symbol, datatype=datatype, end=self.datetime, length=length)
-		if datatype == "open":
-			data.index = pd.Index([d.replace(hour=13, minute=30) for d in data.index])
-		# This timedelta allows us to get data 10 minutes into the future (we can see 20:00 close data even if we run at 19:50)
-		# This is needed so we can get real-time data if we choose to run near market close
-		lookup = pd.Timestamp(self.datetime.replace(tzinfo=data.index.tz) + datetime.timedelta(minutes=10))
-		last_idx = data.index.get_indexer([lookup], method='pad')[0]
-		return data[:last_idx+1]
+	def get_data(self, symbol, datatype, length, timeframe=None):
+		# timeframe defaults to the timeframe of the data source
+		timeframe = timeframe if timeframe is not None else self.data.timeframe
+		times, values = self.data.get_array(symbol, datatype=datatype, end=self.datetime, length=length, timeframe=timeframe)
+		last_idx = self.visible(times, datatype, timeframe)
+		if datatype == "open" and timeframe == 'day':
+			times = times - times % DAY_NS + OPEN_NS
+		index = pd.DatetimeIndex(times[:last_idx].view('datetime64[ns]')).tz_localize('UTC')
+		return pd.Series(values[:last_idx], index=index, name=datatype, copy=False)
+
+
+	def visible(self, times, datatype, timeframe):
+		# Number of leading bars whose value of datatype can be seen at self.datetime
+		width = parse_timeframe(timeframe)
+		# In live mode, the bar that the stream is filling in can be seen as of the last streamed minute
+		live_time = getattr(self.data, 'live_time', None)
+		if width is None:
+			if datatype == "open":
+				times = times - times % DAY_NS + OPEN_NS
+			elif live_time is not None:
+				times = np.where(times - times % DAY_NS == live_time - live_time % DAY_NS, np.minimum(times, live_time), times)
+			# This timedelta allows us to get data 10 minutes into the future (we can see 20:00 close data even if we run at 19:50)
+			# This is needed so we can get real-time data if we choose to run near market close
+			lookup = to_ns(self.datetime + datetime.timedelta(minutes=10))
+		else:
+			# Intraday bars are stamped at their start, so only their open is known before they end
+			if datatype != "open":
+				ends = times + width * MINUTE_NS
+				if live_time is not None:
+					ends = np.where((times < live_time) & (live_time < ends), live_time, ends)
+				times = ends
+			lookup = to_ns(self.datetime)
+		return np.searchsorted(times, lookup, side='right')
+
+
+	def add_indicator(self, indicator, symbol, datatype='close', precompute=False, timeframe=None):
+		# Registers an indicator (see AlgoTrader.Indicators) on the bars of symbol. Before every run and on_bar
+		# it is fed the bars that have become visible since the last call, so indicator.value is always the
+		# value at the current time without recomputing the whole window. With precompute=True it is evaluated
+		# over the whole series once instead, and each call is an index lookup.
+		indicator.bind(symbol, datatype, precompute=precompute, timeframe=timeframe)
+		self.indicators.append(indicator)
+		return indicator
+
+
+	def update_indicators(self):
+		for indicator in self.indicators:
+			# timeframe defaults to the timeframe of the data source
+			timeframe = indicator.timeframe if indicator.timeframe is not None else self.data.timeframe
+			store = self.data.get_store(indicator.datatype, timeframe=timeframe)
+			# Only the last bar before self.datetime can be hidden, so the last two are enough to find the visible end
+			lo, hi = self.data.get_range(indicator.symbol, indicator.datatype, end=self.datetime, length=2, timeframe=timeframe)
+			end = lo + self.visible(store.times[lo:hi], indicator.datatype, timeframe)
+			# In live mode the stream may still be filling in the last bar of the store
+			complete = len(store) - 1 if getattr(self.data, 'live_time', None) is not None else end
+			indicator.feed(store.series(indicator.symbol, indicator.datatype), end, complete)
 
 
 	def order(self, symbol, amount, limit=None, stop=None):
@@ -52,6 +106,10 @@ class Algo:
 		self.broker.order_target_percent(symbol=symbol, percent=percent, limit=limit, stop=stop, time=self.datetime)
 
 
+	def rebalance(self, weights, limit=None, stop=None):
+		self.broker.rebalance(weights=weights, limit=limit, stop=stop, time=self.datetime)
+
+
 	def cancel_orders(self, symbol=None):
 		self.broker.cancel_orders(symbol)
 
@@ -60,15 +118,25 @@ class Algo:
 		self.datetime = time
 		if update and not self.data.live:
 			self.data.update_symbols()
+		self.update_indicators()
 		self.run()
 
 
+	def bar_wrapper(self, time=None):
+		self.datetime = time
+		self.update_indicators()
+		self.on_bar()
+
+
 	def init(self):
 		pass
 
 	def run(self):
 		pass
 
+	def on_bar(self):
+		pass
+
 
 if __name__ == '__main__':
 	from AlgoTrader.AlpacaData import AlpacaData
@@ -1,28 +1,93 @@
-from alpaca.data.historical import CryptoHistoricalDataClient, StockHistoricalDataClient
-from alpaca.data.requests import CryptoBarsRequest, StockBarsRequest
-from alpaca.data.timeframe import TimeFrame
-import alpaca_trade_api as tradeapi
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 import datetime
+import threading
+import time
+import os
 import pandas as pd
 import numpy as np
 import json
-from transformers import pipeline
-from AlgoTrader.Util import get_creds, trading_day_offset
+from AlgoTrader.Util import get_creds, trading_day_offset, to_ns, ns_to_datetime
+from AlgoTrader.PriceStore import PriceStore
+from AlgoTrader.BarCache import BarCache
+from AlgoTrader.Transport import AlpacaTransport
+from AlgoTrader.Sentiment import SentimentModel
 from AlgoTrader.Logger import Logger
+from AlgoTrader.Timeframe import aggregate, DAY_NS, BAR_NS, MINUTE_NS
 
 
 class AlpacaData:
 
-	def __init__(self, symbols=["SPY"], start=1000, end=datetime.datetime.now(), news_data=True):
+	price_types = ['open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap']
+	news_types = ['sentiment', 'news_count']
+
+	def __init__(self, symbols=["SPY"], start=1000, end=datetime.datetime.now(), news_data=True, cache_dir="~/.algotrader/bars", transport=None, max_workers=8, sentiment_model=None, live=False, stream=None, timeframe='day'):
 		self.start, self.end = self.calc_start_end(start, end)
 		self.api_key = get_creds("ALPACA_API_KEY")
 		self.secret_key = get_creds("ALPACA_SECRET_KEY")
 		self.symbols = symbols
 		self.get_news_data = news_data
-		self.price_data = {symbol: None for symbol in symbols}
+		self.prices = None
+		self.news = None
 		self.raw_news_data = {symbol: None for symbol in symbols}
-		self.news_data = {symbol: None for symbol in symbols}
+		self.transport = transport if transport is not None else AlpacaTransport(self.api_key, self.secret_key)
+		self.max_workers = max_workers
+		self.sentiment_model = sentiment_model if sentiment_model is not None or not news_data else SentimentModel()
+		self.timings = {}
+		# timeframe is the default bar size served by get ('day', 'hour', 'minute' or e.g. '5min').
+		# Intraday timeframes fetch minute bars once, and every coarser timeframe is aggregated from them on first use.
+		self.timeframe = timeframe
+		self.base_timeframe = 'day' if timeframe == 'day' else 'minute'
+		self.aggregates = {}
+		self.cache = BarCache(cache_dir, timeframe=self.base_timeframe) if cache_dir is not None else None
+		# In live mode, minute bars from a stream (the transport's websocket by default, or e.g. a ReplayStream)
+		# are merged into the price store as they arrive. Otherwise update_symbols fetches the new bars on demand.
+		self.live = live
+		self.stream = stream
+		self.streams = []
+		# live_time is the end of the last streamed minute bar, and last_prices the last streamed close of each symbol
+		self.live_time = None
+		self.last_prices = None
+		self.lock = threading.RLock()
 		self.fetch_data()
+		if live:
+			self.start_stream()
+
+
+	def save(self, directory):
+		# Writes the price and sentiment stores to disk, so that AlpacaData.load can memory-map them
+		self.prices.save(os.path.join(directory, "prices"))
+		if self.news is not None:
+			self.news.save(os.path.join(directory, "news"))
+		with open(os.path.join(directory, "meta.json"), 'w') as f:
+			json.dump({'symbols': self.symbols, 'start': self.start.isoformat(), 'end': self.end.isoformat(), 'timeframe': self.timeframe, 'base_timeframe': self.base_timeframe}, f)
+
+
+	@classmethod
+	def load(cls, directory, mmap_mode='r'):
+		# An AlpacaData that serves the data saved by save, without any network access
+		with open(os.path.join(directory, "meta.json")) as f:
+			meta = json.load(f)
+		data = cls.__new__(cls)
+		data.symbols = meta['symbols']
+		data.start = datetime.datetime.fromisoformat(meta['start'])
+		data.end = datetime.datetime.fromisoformat(meta['end'])
+		data.timeframe = meta.get('timeframe', 'day')
+		data.base_timeframe = meta.get('base_timeframe', 'day')
+		data.aggregates = {}
+		data.prices = PriceStore.load(os.path.join(directory, "prices"), mmap_mode=mmap_mode)
+		data.news = PriceStore.load(os.path.join(directory, "news"), mmap_mode=mmap_mode) if os.path.exists(os.path.join(directory, "news")) else None
+		data.get_news_data = data.news is not None
+		data.raw_news_data = {}
+		data.cache = None
+		data.transport = None
+		data.timings = {}
+		data.live = False
+		data.stream = None
+		data.streams = []
+		data.live_time = None
+		data.last_prices = None
+		data.lock = threading.RLock()
+		return data
 
 
 	def calc_start_end(self, start, end):
@@ -40,110 +105,307 @@ class AlpacaData:
 		return start, end
 
 
-	def get(self, symbol, datatype, start=None, end=None, length=None):
-		start, end = self.calc_start_end(start, end)
-		if start is not None:
-			start = start.replace(tzinfo=self.price_data[symbol].index.tz)
-		if end is not None:
-			end = end.replace(tzinfo=self.price_data[symbol].index.tz)
-		if isinstance(start, datetime.datetime):
-			start = pd.Timestamp(start)
-		if isinstance(end, datetime.datetime):
-			end = pd.Timestamp(end)
-		if datatype in ['open', 'high', 'low', 'close', 'volume', 'trade_count', 'vwap']:
-			data = self.price_data
-		elif datatype in ['sentiment', 'news_count']:
-			data = self.news_data
+	def get(self, symbol, datatype, start=None, end=None, length=None, timeframe=None):
+		with self.lock:
+			store = self.get_store(datatype, timeframe=timeframe)
+			lo, hi = self.get_range(symbol, datatype, start=start, end=end, length=length, timeframe=timeframe)
+			values = store.series(symbol, datatype)[lo:hi]
+			values.setflags(write=False)
+			return pd.Series(values, index=store.datetimes[lo:hi], name=datatype, copy=False)
+
+
+	def get_array(self, symbol, datatype, start=None, end=None, length=None, timeframe=None):
+		# Same lookup as get, but returns views of the int64 nanosecond timestamps and the values. The views are
+		# read-only, since writing through them would change the store for every later read.
+		with self.lock:
+			store = self.get_store(datatype, timeframe=timeframe)
+			lo, hi = self.get_range(symbol, datatype, start=start, end=end, length=length, timeframe=timeframe)
+			times, values = store.times[lo:hi], store.series(symbol, datatype)[lo:hi]
+			times.setflags(write=False)
+			values.setflags(write=False)
+			return times, values
+
+
+	def get_frame(self, symbol, news=False):
+		store = self.news if news else self.prices
+		return store.frame(symbol)
+
+
+	def get_store(self, datatype, timeframe=None):
+		if datatype in AlpacaData.price_types:
+			return self.price_store(timeframe)
+		elif datatype in AlpacaData.news_types:
+			return self.news
 		else:
 			raise ValueError(f"datatype {datatype} not recognised.")
+
+
+	def price_store(self, timeframe=None):
+		# The prices at the given timeframe (self.timeframe by default). Coarser timeframes than the fetched bars
+		# are aggregated once and cached. When bars are added, only the bars from the last aggregated one onwards
+		# are aggregated again.
+		if timeframe is None:
+			timeframe = self.timeframe
+		if timeframe == self.base_timeframe:
+			return self.prices
+		if self.base_timeframe == 'day':
+			raise ValueError(f"timeframe {timeframe} is finer than the fetched daily bars.")
+		with self.lock:
+			if timeframe not in self.aggregates:
+				store, sources = aggregate(self.prices, timeframe)
+				self.aggregates[timeframe] = (store, sources, len(self.prices))
+			store, sources, size = self.aggregates[timeframe]
+			if size < len(self.prices):
+				lo = sources[-1] if len(sources) > 0 else 0
+				new_store, new_sources = aggregate(self.prices, timeframe, lo=lo)
+				for idx, time in enumerate(new_store.times):
+					column = store.column(time)
+					store.data[:,:,column] = new_store.data[:,:,idx]
+				sources = np.concatenate([sources[:-1], new_sources]) if len(new_sources) > 0 else sources
+				self.aggregates[timeframe] = (store, sources, len(self.prices))
+			return store
+
+
+	def get_range(self, symbol, datatype, start=None, end=None, length=None, timeframe=None):
+		if isinstance(start, int) or isinstance(end, int):
+			start, end = self.calc_start_end(start, end)
+		index = self.get_store(datatype, timeframe=timeframe).index
 		if start is None:
 			if length is None:
 				length = 1
-			end = data[symbol].index.get_indexer([end], method='bfill')[0]+1
-			start = max(0, end-length)
-		if end is None:
-			if length is None:
-				end = data[symbol].index[-1]
-			else:
-				start = data[symbol].index.get_indexer([start], method='pad')[0]
-				end = min(len(data[symbol])-1, start+length)
-		return data[symbol][datatype][start:end]
+			hi = len(index) if end is None else min(len(index), index.seek(end, side='left') + 1)
+			lo = max(0, hi - length)
+		elif end is None:
+			lo = max(0, index.seek(start, side='right') - 1)
+			hi = len(index) if length is None else min(len(index), lo + length)
+		else:
+			lo = index.seek(start, side='left')
+			hi = index.seek(end, side='right')
+		return lo, hi
 
 
 	def quote(self, symbol, time):
-		idx = self.price_data[symbol].index.get_indexer([pd.Timestamp(time.replace(tzinfo=self.price_data[symbol].index.tz))], method='bfill')[0]
-		idx_time = self.price_data[symbol].index[idx]
-		curr_time = pd.Timestamp(time)
-		if curr_time.to_pydatetime().time() < datetime.time(19,50):
-			datatype = 'open'
+		return self.quote_all(time)[self.prices.symbol_idx[symbol]]
+
+
+	def quote_all(self, time):
+		# Cross section of the quoted price of every symbol (ordered as in self.prices.symbols).
+		# In live mode, once bars have been streamed the quote is the last streamed close of each symbol.
+		with self.lock:
+			# A time after the last bar is quoted at the last bar
+			idx = min(self.prices.index.seek(time, side='left'), len(self.prices) - 1)
+			quotes = self.prices.quote_section(self.quote_type(time), idx)
+			if self.live_time is not None and to_ns(time) >= self.live_time:
+				quotes = np.where(np.isnan(self.last_prices), quotes, self.last_prices)
+			return quotes
+
+
+	def quote_type(self, time):
+		if time.time() < datetime.time(19,50):
+			return 'open'
 		else:
-			datatype = 'close'
-		return self.price_data[symbol][datatype][idx]
+			return 'close'
 
 
 	def fetch_data(self):
-		for symbol in self.symbols:
-			is_crypto = "\\" in symbol
-			price_bars = None
-			news_bars = None
-			if is_crypto:
-				client = CryptoHistoricalDataClient()
-				request_params = CryptoBarsRequest(
-				                        symbol_or_symbols=symbol,
-				                        timeframe=TimeFrame.Day,
-				                        start=self.start,
-				                        end=self.end,
-				                 )
-				price_bars = client.get_crypto_bars(request_params).df
-			else:
-				client = StockHistoricalDataClient(self.api_key, self.secret_key)
-				request_params = StockBarsRequest(
-				                        symbol_or_symbols=symbol,
-				                        timeframe=TimeFrame.Day,
-				                        start=self.start,
-				                        end=self.end,
-				                 )
-				price_bars = client.get_stock_bars(request_params).df.droplevel("symbol")
-			price_bars.index = pd.Index([d.replace(hour=20,minute=0) for d in price_bars.index])
-			self.price_data[symbol] = price_bars
+		# Price batches and news downloads run concurrently on a bounded thread pool.
+		# Sentiment scoring starts as soon as each symbol's news has arrived.
+		start_time = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+			price_futures = self.request_bars(self.symbols, pool=pool)
+			news_futures = {}
+			if self.get_news_data:
+				news_futures = {pool.submit(self.fetch_news, symbol): symbol for symbol in self.symbols}
+			price_frames = self.collect_bars(self.symbols, price_futures)
+			if self.base_timeframe == 'day':
+				for symbol, price_bars in price_frames.items():
+					price_bars.index = pd.Index([d.replace(hour=20,minute=0) for d in price_bars.index])
+			self.prices = PriceStore.from_frames(price_frames, fields=AlpacaData.price_types)
+			self.timings['prices'] = time.perf_counter() - start_time
 			if self.get_news_data:
-				if is_crypto:
-					symbol = "$" + symbol.split("/")[0]
-				client = tradeapi.REST(self.api_key, self.secret_key, base_url="https://api.alpaca.markets", api_version='v2')
-				news = client.get_news(symbol=symbol, start=self.start.strftime("%Y-%m-%d"), end=self.end.strftime("%Y-%m-%d"), sort=tradeapi.rest.Sort.Asc, limit=100000)
-				headlines = pd.Series([article.headline for article in news])
-				summaries = pd.Series([article.summary for article in news])
-				dates = pd.Index([article.created_at for article in news], name='timestamp')
-				news_bars = pd.DataFrame()
-				news_bars["headline"] = headlines
-				news_bars["summary"] = summaries
-				news_bars.index = dates
-				self.raw_news_data[symbol] = news_bars
-				self.news_data[symbol] = self.sentiment(news_bars, price_bars.index)
+				news_frames = {}
+				self.timings['sentiment'] = 0.
+				for future in as_completed(news_futures):
+					symbol = news_futures[future]
+					self.raw_news_data[symbol] = future.result()
+					self.timings['news'] = time.perf_counter() - start_time
+					sentiment_start = time.perf_counter()
+					news_frames[symbol] = self.sentiment(self.raw_news_data[symbol], self.price_store('day').datetimes)
+					self.timings['sentiment'] += time.perf_counter() - sentiment_start
+				self.news = PriceStore.from_frames({symbol: news_frames[symbol] for symbol in self.symbols}, fields=AlpacaData.news_types)
+		self.timings['total'] = time.perf_counter() - start_time
+
+
+	def fetch_news(self, symbol):
+		news_symbol = symbol
+		if self.is_crypto(symbol):
+			news_symbol = "$" + symbol.split("/")[0]
+		return self.transport.get_news(news_symbol, self.start, self.end)
+
+
+	def load_bars(self, symbols, pool=None):
+		return self.collect_bars(symbols, self.request_bars(symbols, pool=pool))
+
+
+	def request_bars(self, symbols, pool=None):
+		# Finds the ranges which are not in the local cache yet, and starts fetching them.
+		# Symbols of the same asset class that are missing the same range are fetched together.
+		start, end = self.start.replace(tzinfo=None), self.end.replace(tzinfo=None)
+		requests = {}
+		for symbol in symbols:
+			missing = [(start, end)] if self.cache is None else self.cache.missing(symbol, start, end)
+			for missing_start, missing_end in missing:
+				requests.setdefault((self.is_crypto(symbol), missing_start, missing_end), []).append(symbol)
+		futures = {}
+		for (is_crypto, missing_start, missing_end), request_symbols in requests.items():
+			for idx in range(0, len(request_symbols), self.transport.max_batch_size):
+				batch = request_symbols[idx:idx+self.transport.max_batch_size]
+				if pool is None:
+					future = self.fetch_bars(batch, missing_start, missing_end, is_crypto)
+				else:
+					future = pool.submit(self.fetch_bars, batch, missing_start, missing_end, is_crypto)
+				futures[(tuple(batch), missing_start, missing_end)] = future
+		return futures
+
+
+	def collect_bars(self, symbols, futures):
+		# Waits for the requests from request_bars, merges them into the cache, and returns the bars of each symbol
+		start, end = self.start.replace(tzinfo=None), self.end.replace(tzinfo=None)
+		fetched = {symbol: [] for symbol in symbols}
+		for (batch, missing_start, missing_end), future in futures.items():
+			bars = future.result() if isinstance(future, Future) else future
+			for symbol in batch:
+				fetched[symbol].append((bars[symbol], missing_start, missing_end))
+		frames = {}
+		for symbol in symbols:
+			if self.cache is None:
+				frames[symbol] = fetched[symbol][0][0]
+				continue
+			for bars, missing_start, missing_end in fetched[symbol]:
+				self.cache.store(symbol, bars, missing_start, missing_end)
+			bars = self.cache.load(symbol)
+			frames[symbol] = bars[(bars.index >= pd.Timestamp(start, tz='UTC')) & (bars.index <= pd.Timestamp(end, tz='UTC'))]
+		return frames
+
+
+	def fetch_bars(self, symbols, start, end, is_crypto=False):
+		# Fetches one batch of symbols, and splits the result by symbol
+		price_bars = self.transport.get_bars(symbols, start, end, is_crypto=is_crypto, timeframe=self.base_timeframe)
+		bars = {symbol: pd.DataFrame(columns=AlpacaData.price_types, index=pd.DatetimeIndex([], tz='UTC', name='timestamp')) for symbol in symbols}
+		if isinstance(price_bars.index, pd.MultiIndex):
+			for symbol, symbol_bars in price_bars.groupby(level="symbol", sort=False):
+				bars[symbol] = symbol_bars.droplevel("symbol")
+		return bars
+
+
+	def update_symbols(self):
+		# Fetches the bars from the day of the last bar in the store until now, and writes them into the store in place
+		# (the last bar is overwritten, since it may have been partial), instead of downloading the whole history again
+		start = ns_to_datetime(self.prices.times[-1]) if len(self.prices) > 0 else self.start.replace(tzinfo=None)
+		start = start.replace(hour=0, minute=0)
+		end = datetime.datetime.utcnow()
+		groups = {}
+		for symbol in self.symbols:
+			groups.setdefault(self.is_crypto(symbol), []).append(symbol)
+		for is_crypto, symbols in groups.items():
+			for idx in range(0, len(symbols), self.transport.max_batch_size):
+				bars = self.fetch_bars(symbols[idx:idx+self.transport.max_batch_size], start, end, is_crypto)
+				for symbol, symbol_bars in bars.items():
+					self.set_bars(symbol, symbol_bars)
+		self.end = end
+
+
+	def stamp(self, time):
+		# The time (int64 ns) of the bar a fetched bar is stored at: daily bars are stamped at 20:00 of their day
+		if self.base_timeframe == 'day':
+			return time - time % DAY_NS + BAR_NS
+		return time
+
+
+	def set_bars(self, symbol, bars):
+		# Writes bars (a DataFrame indexed by timestamp) into the store, appending any new ones
+		fields = [self.prices.field_idx[field] for field in AlpacaData.price_types]
+		s = self.prices.symbol_idx[symbol]
+		values = bars.reindex(columns=AlpacaData.price_types).to_numpy(dtype=np.float64)
+		with self.lock:
+			for timestamp, row in zip(bars.index, values):
+				idx = self.prices.column(self.stamp(to_ns(timestamp)))
+				if idx is not None:
+					self.prices.data[fields, s, idx] = row
+					self.prices.invalidate(idx)
+
+
+	def start_stream(self):
+		# Subscribes to the minute bars of every symbol, and runs each stream on a background thread
+		if self.stream is not None:
+			streams = [(self.stream, self.symbols)]
+		else:
+			groups = {}
+			for symbol in self.symbols:
+				groups.setdefault(self.is_crypto(symbol), []).append(symbol)
+			streams = [(self.transport.get_stream(is_crypto), symbols) for is_crypto, symbols in groups.items()]
+		for stream, symbols in streams:
+			stream.subscribe_bars(self.on_stream_bar, *symbols)
+			thread = threading.Thread(target=stream.run, daemon=True)
+			thread.start()
+			self.streams.append((stream, thread))
+
+
+	def stop_stream(self):
+		for stream, thread in self.streams:
+			stream.stop()
+		self.streams = []
+
+
+	async def on_stream_bar(self, bar):
+		self.merge_bar(bar.symbol, bar.timestamp, {field: getattr(bar, field) for field in AlpacaData.price_types})
+
+
+	def merge_bar(self, symbol, timestamp, bar):
+		# Stores a minute bar in place (or folds it into the daily bar of its day), so get and quote see it immediately
+		f = self.prices.field_idx
+		with self.lock:
+			if self.last_prices is None:
+				self.last_prices = np.full(len(self.prices.symbols), np.nan)
+			self.last_prices[self.prices.symbol_idx[symbol]] = bar['close']
+			self.live_time = max(self.live_time or 0, to_ns(timestamp) + MINUTE_NS)
+			idx = self.prices.column(self.stamp(to_ns(timestamp)))
+			if idx is None:
+				return
+			self.prices.invalidate(idx)
+			values = self.prices.data[:, self.prices.symbol_idx[symbol], idx]
+			if np.isnan(values[f['open']]) or self.base_timeframe != 'day':
+				for field in AlpacaData.price_types:
+					values[f[field]] = bar[field]
+				return
+			volume = values[f['volume']] + bar['volume']
+			if volume > 0:
+				values[f['vwap']] = (values[f['vwap']] * values[f['volume']] + bar['vwap'] * bar['volume']) / volume
+			values[f['high']] = max(values[f['high']], bar['high'])
+			values[f['low']] = min(values[f['low']], bar['low'])
+			values[f['close']] = bar['close']
+			values[f['volume']] = volume
+			values[f['trade_count']] += bar['trade_count']
+
+
+	def is_crypto(self, symbol):
+		return "/" in symbol
 
 
 	def sentiment(self, news_data, dates):
-		analyser = pipeline("sentiment-analysis", model="ahmedrachid/FinancialBERT-Sentiment-Analysis")
-		# mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis
-		# ahmedrachid/FinancialBERT-Sentiment-Analysis
-		dates = pd.Index([d.replace(hour=23, minute=59) for d in dates])
+		# Each article counts towards the first date on or after the day it was published
+		dates = dates.normalize() + pd.Timedelta(hours=23, minutes=59)
 		score = np.zeros(len(dates))
 		count = np.zeros(len(dates))
-		idx = 0
-		for date, article in news_data.iterrows():
-			while date.date() > dates[idx].date():
-				idx += 1
-			if len(article["summary"]) == 0:
-				continue
-			result = analyser(article["summary"])[0]
-			classification = 0
-			if result['label'] == "positive":
-				classification = 1
-			elif result['label'] == "negative":
-				classification = -1
-			confidence = result['score']
-			score[idx] += classification * confidence
-			count[idx] += 1
+		articles = news_data[(news_data["summary"].fillna("").str.len() > 0).to_numpy()]
+		if len(articles) > 0:
+			ids = articles["id"].tolist() if "id" in articles.columns else None
+			article_score = self.sentiment_model.score(articles["summary"].tolist(), ids=ids)
+			article_days = pd.DatetimeIndex(articles.index).values.astype('datetime64[D]')
+			idx = np.searchsorted(dates.values.astype('datetime64[D]'), article_days, side='left')
+			valid = idx < len(dates)
+			score = np.bincount(idx[valid], weights=article_score[valid], minlength=len(dates))
+			count = np.bincount(idx[valid], minlength=len(dates)).astype(np.float64)
 		count_nonzero = count.copy()
 		count_nonzero[count_nonzero==0] = 1
 		score = score / count_nonzero
@@ -0,0 +1,89 @@
+import os
+import json
+import datetime
+import pandas as pd
+import pyarrow.parquet as pq
+from AlgoTrader.Timeframe import parse_timeframe
+
+
+class BarCache:
+
+	# On-disk cache of fetched bars. Each (symbol, timeframe) is stored as a parquet file, next to a
+	# json file recording the date range that has been fetched, so only the missing head/tail is re-fetched.
+	def __init__(self, directory, timeframe='day'):
+		self.directory = os.path.join(os.path.expanduser(directory), timeframe)
+		self.timeframe = timeframe
+		os.makedirs(self.directory, exist_ok=True)
+
+
+	def path(self, symbol, ext='parquet'):
+		name = symbol.replace("/", "-").replace("\\", "-")
+		return os.path.join(self.directory, "{name}.{ext}".format(name=name, ext=ext))
+
+
+	def coverage(self, symbol):
+		try:
+			with open(self.path(symbol, ext='json')) as f:
+				covered = json.load(f)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return None
+		try:
+			pq.read_metadata(self.path(symbol))
+		except (OSError, ValueError):
+			# The parquet file is missing or was cut short, so the symbol is fetched again as if it was never cached
+			self.invalidate(symbol)
+			return None
+		return datetime.datetime.fromisoformat(covered['start']), datetime.datetime.fromisoformat(covered['end'])
+
+
+	def missing(self, symbol, start, end):
+		# The (start, end) ranges within [start, end] that are not in the cache
+		covered = self.coverage(symbol)
+		if covered is None:
+			return [(start, end)]
+		ranges = []
+		if start < covered[0]:
+			ranges.append((start, covered[0]))
+		if end > covered[1]:
+			ranges.append((covered[1], end))
+		return ranges
+
+
+	def load(self, symbol):
+		if self.coverage(symbol) is None:
+			return None
+		try:
+			return pd.read_parquet(self.path(symbol))
+		except (OSError, ValueError):
+			self.invalidate(symbol)
+			return None
+
+
+	def invalidate(self, symbol):
+		for ext in ('json', 'parquet'):
+			try:
+				os.remove(self.path(symbol, ext=ext))
+			except FileNotFoundError:
+				pass
+
+
+	def store(self, symbol, bars, start, end):
+		# Merges bars fetched for [start, end] into the cache. The new range must touch the cached one.
+		cached = self.load(symbol)
+		covered = self.coverage(symbol)
+		if cached is not None:
+			bars = pd.concat([cached, bars])
+			bars = bars[~bars.index.duplicated(keep='last')].sort_index()
+			start, end = min(start, covered[0]), max(end, covered[1])
+		# Ranges are UTC. The last bar may still be forming if it started less than a bar ago, so the coverage
+		# then ends at its start, and the next top-up fetches it again.
+		now = datetime.datetime.utcnow()
+		width = parse_timeframe(self.timeframe)
+		width = datetime.timedelta(days=1) if width is None else datetime.timedelta(minutes=width)
+		end = min(end, now)
+		if end > now - width and len(bars) > 0:
+			end = max(start, min(end, bars.index[-1].tz_convert('UTC').tz_localize(None).to_pydatetime()))
+		bars.to_parquet(self.path(symbol))
+		with open(self.path(symbol, ext='json'), 'w') as f:
+			json.dump({'start': start.isoformat(), 'end': end.isoformat()}, f)
+		return bars
@@ -1,7 +1,14 @@
 import math
+import time
+import uuid
+import bisect
 import datetime
+import threading
+import numpy as np
 import pandas as pd
 from AlgoTrader.Util import get_creds
+from AlgoTrader.OrderGateway import OrderGateway
+from AlgoTrader.Clients import get_api
 
 class BacktestBroker:
 
@@ -9,8 +16,17 @@ class BacktestBroker:
 		self.cash = cash
 		self.value = cash
 		self.data = data
-		self.positions = {}
+		# positions are stored in arrays indexed by the symbol's position in the data store
+		self.symbols = data.prices.symbols
+		self.symbol_idx = data.prices.symbol_idx
+		self.amounts = np.zeros(len(self.symbols))
+		self.entry_prices = np.zeros(len(self.symbols))
+		self.last_prices = np.zeros(len(self.symbols))
+		self.quotes = None
+		self.quote_time = None
+		self.value_time = None
 		self.limit_orders = {} # (symbol, starttime): (price, amount, above(1)/below(-1))
+		self.order_books = {} # symbol: OrderBook
 
 
 	def order(self, symbol, amount, limit=None, stop=None, price=None, time=None):
@@ -19,11 +35,11 @@ class BacktestBroker:
 			return
 
 		if price is None:
-			price = self.data.quote(symbol, time)
+			price = self.get_quotes(time)[self.symbol_idx[symbol]]
 
 		if (limit is None) and (stop is None or amount > 0):
 			total_price = price * amount
-			current_shares = self.get_position_amount(symbol)
+			current_shares = BacktestBroker.get_position_amount(self, symbol)
 			if total_price > self.cash:
 				print(('Order Failed: {amount} shares of {symbol} at ${price} '
 						 'costs {total_price}, but you only have ${cash} in cash.')
@@ -36,18 +52,12 @@ class BacktestBroker:
 						 .format(amount=amount, symbol=symbol, actual_shares=current_shares))
 				return
 			self.cash -= total_price
-			if symbol not in self.positions:
-				self.positions[symbol] = {
-						'amount': 0,
-						'avg entry price': 0.0,
-						'price': 0.0
-					}
-			if self.positions[symbol]['amount'] + amount != 0:
-				self.positions[symbol]['avg entry price'] = \
-						(self.positions[symbol]['amount'] * self.positions[symbol]['avg entry price'] + 
-						 price * amount) / (self.positions[symbol]['amount'] + amount)
-			self.positions[symbol]['amount'] += amount
-			self.positions[symbol]['price'] = price
+			idx = self.symbol_idx[symbol]
+			if self.amounts[idx] + amount != 0:
+				self.entry_prices[idx] = (self.amounts[idx] * self.entry_prices[idx] + price * amount) / (self.amounts[idx] + amount)
+			self.amounts[idx] += amount
+			self.last_prices[idx] = price
+			self.value_time = None
 			if amount > 0:
 				print("Buying {amount} shares of {symbol} at ${price:.2f}.".format(amount=amount, symbol=symbol, price=price))
 			elif amount < 0:
@@ -60,48 +70,78 @@ class BacktestBroker:
 					'and when selling the limit must be >0.').format(amount=amount, limit=limit))
 			sign = limit / abs(limit) if (limit != 0) else 1
 			limit_price = (1.0 + limit) * price
-			self.limit_orders[(symbol, time)] = (limit_price, amount, sign)
+			self.add_limit_order(symbol, time, limit_price, amount, sign)
 
 		if stop is not None:
 			sign = stop / abs(stop) if (stop != 0) else 1
 			stop_price = (1.0 + stop) * price
-			self.limit_orders[(symbol, time)] = (stop_price, -abs(amount), sign)
+			self.add_limit_order(symbol, time, stop_price, -abs(amount), sign)
+
+
+	def add_limit_order(self, symbol, time, price, amount, sign):
+		key = (symbol, time)
+		if symbol not in self.order_books:
+			self.order_books[symbol] = OrderBook()
+		book = self.order_books[symbol]
+		if key in self.limit_orders:
+			book.remove(key)
+		elif len(book) == 0:
+			book.checked = max(book.checked, self.first_limit_bar(time))
+		self.limit_orders[key] = (price, amount, sign)
+		book.add(key, price, sign)
+
+
+	def first_limit_bar(self, time):
+		# only bars after the time the order is placed can trigger it (the same cut check_limit_orders uses)
+		return self.data.prices.index.seek(time, side='right')
 
 
 
 	def check_limit_orders(self, time=None):
-		for (symbol, starttime), (price, amount, sign) in list(self.limit_orders.items()):
-			hist = self.data.get(symbol, start=starttime, end=time)
-			if sign < 0:
-				low = hist['low'].min()
-				if low < price:
-					if amount < 0:
-						print(('Stop Loss kicking in. Selling {amount} shares of {symbol} ' 
-							'at ${price:.2f}.').format(amount=abs(amount), symbol=symbol, price=price))
-					else:
-						print(('Limit Order kicking in. Buying {amount} shares of {symbol} '
-							'at ${price:.2f}.').format(amount=amount, symbol=symbol, price=price))
-					self.order(symbol=symbol, amount=amount, price=price, time=time)
-					del self.limit_orders[(symbol, starttime)]
-			else:
-				high = hist['high'].max()
-				if high > price:
-					if amount < 0:
-						print(('Take Gain kickin in. Selling {amount} shares of {symbol} ' 
-							'at ${price:.2f}').format(amount=abs(amount), symbol=symbol, price=price))
+		# Each bar that has closed since the last check is compared against the edges of each symbol's
+		# order book. If a bar gaps through the order's price, the order fills at the bar's open.
+		end = self.data.prices.index.seek(time, side='right')
+		for symbol, book in self.order_books.items():
+			if len(book) == 0:
+				book.checked = max(book.checked, end)
+				continue
+			opens = self.data.prices.series(symbol, 'open')
+			lows = self.data.prices.series(symbol, 'low')
+			highs = self.data.prices.series(symbol, 'high')
+			for bar in range(book.checked, end):
+				for key in book.triggered(low=lows[bar], high=highs[bar]):
+					price, amount, sign = self.limit_orders.pop(key)
+					book.remove(key)
+					if sign < 0:
+						price = min(price, opens[bar])
+						if amount < 0:
+							print(('Stop Loss kicking in. Selling {amount} shares of {symbol} ' 
+								'at ${price:.2f}.').format(amount=abs(amount), symbol=symbol, price=price))
+						else:
+							print(('Limit Order kicking in. Buying {amount} shares of {symbol} '
+								'at ${price:.2f}.').format(amount=amount, symbol=symbol, price=price))
 					else:
-						print(('Invalid Limit Order. You are ttempting to place a buy order '
-							'for a price higher than the current price.'))
-					self.order(symbol=symbol, amount=amount, price=price, time=time)
-					del self.limit_orders[(symbol, starttime)]
+						price = max(price, opens[bar])
+						if amount < 0:
+							print(('Take Gain kickin in. Selling {amount} shares of {symbol} ' 
+								'at ${price:.2f}').format(amount=abs(amount), symbol=symbol, price=price))
+						else:
+							print(('Invalid Limit Order. You are ttempting to place a buy order '
+								'for a price higher than the current price.'))
+					self.fill(symbol=symbol, amount=amount, price=price, time=time)
+			book.checked = max(book.checked, end)
+
+
 
+	def fill(self, symbol, amount, price, time=None):
+		self.order(symbol=symbol, amount=amount, price=price, time=time)
 
 
 	def order_target_percent(self, symbol, percent, limit=None, stop=None, time=None):
 		account = self.get_value(time)
-		cash = account['cash']
+		cash = account['cash'] - self.committed_cash(time)
 		value = account['value']
-		price = self.data.quote(symbol, time)
+		price = self.get_quotes(time)[self.symbol_idx[symbol]]
 		current_amount = self.get_position_amount(symbol)
 		desired_amount = math.floor(value * percent / price)
 		diff = desired_amount - current_amount
@@ -119,50 +159,397 @@ class BacktestBroker:
 		self.order(symbol=symbol, amount=diff, limit=limit, stop=stop, time=time)
 
 
+	def rebalance(self, weights, limit=None, stop=None, time=None):
+		# Orders every symbol in weights towards its target fraction of the portfolio, using one
+		# snapshot of the account. Sells are placed before buys so that they free up cash first.
+		weights = pd.Series(weights, dtype=np.float64)
+		if (weights > 1).any() or (weights < 0).any() or weights.sum() > 1 + 1e-9:
+			print("Rebalance Failed. The target weights must be between 0 and 1, and sum to at most 1, \
+					but you entered {weights}.".format(weights=weights.to_dict()))
+			return
+		value = self.get_value(time)['value']
+		idx = np.array([self.symbol_idx[symbol] for symbol in weights.index], dtype=np.int64)
+		prices = self.get_quotes(time)[idx]
+		diffs = np.floor(value * weights.values / prices) - np.array([self.get_position_amount(symbol) for symbol in weights.index])
+		for order_idx in np.concatenate([np.flatnonzero(diffs < 0), np.flatnonzero(diffs > 0)]):
+			amount = int(diffs[order_idx])
+			self.order(symbol=weights.index[order_idx], amount=amount, limit=limit, stop=stop, price=prices[order_idx], time=time)
+
+
 	def get_position_amount(self, symbol):
-		if symbol in self.positions:
-			return self.positions[symbol]['amount']
+		if symbol in self.symbol_idx:
+			amount = self.amounts[self.symbol_idx[symbol]]
+			return int(amount) if amount.is_integer() else float(amount)
 		return 0
 
 
+	def committed_cash(self, time=None):
+		# Cash that orders which have not filled yet will spend
+		return 0.
+
+
+	def get_quotes(self, time=None):
+		# Cross section of the prices of every symbol, fetched once per timestamp
+		if self.quote_time != time:
+			self.quotes = self.data.quote_all(time)
+			self.quote_time = time
+		return self.quotes
+
+
 	def get_positions(self, time=None):
-		for symbol in self.positions.keys():
-			if self.positions[symbol]['amount'] == 0:
-				del self.positions[symbol]
-				continue
-			self.positions[symbol]['price'] = self.data.quote(symbol, time)
-		return self.positions
+		held = np.flatnonzero(self.amounts)
+		self.last_prices[held] = self.get_quotes(time)[held]
+		positions = {}
+		for idx in held:
+			positions[self.symbols[idx]] = {
+					'amount': self.get_position_amount(self.symbols[idx]),
+					'avg entry price': self.entry_prices[idx],
+					'price': self.last_prices[idx]
+				}
+		return positions
 
 
 	def get_value(self, time=None):
-		positions_value = 0
-		for symbol in self.positions.keys():
-			self.positions[symbol]['price'] = self.data.quote(symbol, time)
-			positions_value += self.positions[symbol]['price'] * self.positions[symbol]['amount']
-		self.value = self.cash + positions_value
+		# Marked to market with one dot product, and cached until the time changes or an order fills
+		if self.value_time is None or self.value_time != time:
+			held = self.amounts != 0
+			self.last_prices[held] = self.get_quotes(time)[held]
+			self.value = self.cash + np.dot(self.amounts[held], self.last_prices[held])
+			self.value_time = time
 		return {"value": self.value, "cash": self.cash}
 
 
 	def cancel_orders(self, symbol=None):
 		if symbol is None:
 			self.limit_orders = {}
+			for book in self.order_books.values():
+				book.clear()
 		else:
 			for stock, order_placed in list(self.limit_orders.keys()):
 				if stock==symbol:
 					del self.limit_orders[(stock, order_placed)]
+			if symbol in self.order_books:
+				self.order_books[symbol].clear()
+
+
+
+class EventBroker(BacktestBroker):
+
+	# Broker for the event-driven backtest engine. Prices are the closes of the last bar that has been
+	# streamed, and orders are queued and filled at the open of the next bar.
+	def __init__(self, data, cash=10000):
+		super().__init__(data, cash=cash)
+		self.bar = -1
+		self.pending = []
+		self.filling = False
+
+
+	def set_bar(self, bar):
+		self.bar = bar
+		self.quotes = self.data.prices.quote_section('close', bar) if bar >= 0 else np.full(len(self.symbols), np.nan)
+		self.value_time = None
+
+
+	def get_quotes(self, time=None):
+		return self.quotes
+
+
+	def order(self, symbol, amount, limit=None, stop=None, price=None, time=None):
+		if amount == 0:
+			return
+		if limit is None and stop is None:
+			# Market orders for the same symbol are merged into one, which is what fills at the next open
+			for idx, (queued_symbol, queued_amount, queued_limit, queued_stop) in enumerate(self.pending):
+				if queued_symbol == symbol and queued_limit is None and queued_stop is None:
+					if queued_amount + amount == 0:
+						del self.pending[idx]
+					else:
+						self.pending[idx] = (symbol, queued_amount + amount, None, None)
+					return
+		self.pending.append((symbol, amount, limit, stop))
+
+
+	def queued(self):
+		# The queued orders that fill as market orders at the next open (the others become limit orders)
+		return [(symbol, amount) for symbol, amount, limit, stop in self.pending if limit is None and (stop is None or amount > 0)]
+
+
+	def get_position_amount(self, symbol):
+		# Positions count the queued orders, so that sizing an order again before the next bar does not repeat it
+		return super().get_position_amount(symbol) + sum(amount for queued_symbol, amount in self.queued() if queued_symbol == symbol)
+
+
+	def committed_cash(self, time=None):
+		quotes = self.get_quotes(time)
+		return sum(amount * quotes[self.symbol_idx[symbol]] for symbol, amount in self.queued())
+
+
+	def fill(self, symbol, amount, price, time=None):
+		BacktestBroker.order(self, symbol=symbol, amount=amount, price=price, time=time)
+
+
+	def first_limit_bar(self, time):
+		# Limit and stop orders placed at the open of the current bar (by fill_pending) can be triggered by the rest of it
+		return self.bar if self.filling else super().first_limit_bar(time)
+
+
+	def fill_pending(self, time=None):
+		# Orders queued since the last bar are filled at the open of the current bar, in the order they were placed.
+		# They were sized at the last close, so a market order is reduced to what the open allows: a buy to the
+		# shares the cash can pay for, and a sell to the shares held (e.g. after a stop loss sold them in between).
+		pending, self.pending = self.pending, []
+		opens = self.data.prices.cross_section('open', self.bar)
+		self.filling = True
+		for symbol, amount, limit, stop in pending:
+			price = opens[self.symbol_idx[symbol]]
+			if np.isnan(price):
+				# The symbol has no bar here (e.g. it is halted), so the order waits for the next one
+				self.pending.append((symbol, amount, limit, stop))
+				continue
+			if limit is None and amount > 0 and amount * price > self.cash:
+				amount = math.floor(self.cash / price)
+			elif limit is None and stop is None and amount < 0:
+				amount = max(amount, -BacktestBroker.get_position_amount(self, symbol))
+			if amount == 0:
+				continue
+			BacktestBroker.order(self, symbol=symbol, amount=amount, limit=limit, stop=stop, price=price, time=time)
+		self.filling = False
+
+
+
+class OrderBook:
+
+	# Pending limit/stop orders for one symbol. Orders that trigger when the price falls below them and
+	# orders that trigger when it rises above them are each kept sorted by price, so a bar only has to
+	# bisect its low and high into the book to find every order it triggers.
+	def __init__(self):
+		self.below_prices, self.below_keys = [], []
+		self.above_prices, self.above_keys = [], []
+		self.checked = 0 # bars before this position have already been checked
+
+
+	def __len__(self):
+		return len(self.below_keys) + len(self.above_keys)
+
+
+	def add(self, key, price, sign):
+		prices, keys = (self.below_prices, self.below_keys) if sign < 0 else (self.above_prices, self.above_keys)
+		idx = bisect.bisect_right(prices, price)
+		prices.insert(idx, price)
+		keys.insert(idx, key)
+
+
+	def remove(self, key):
+		for prices, keys in [(self.below_prices, self.below_keys), (self.above_prices, self.above_keys)]:
+			if key in keys:
+				idx = keys.index(key)
+				del prices[idx]
+				del keys[idx]
+
+
+	def triggered(self, low, high):
+		# Orders below the price trigger if the low goes under them (the highest one is hit first),
+		# and orders above the price trigger if the high goes over them (the lowest one is hit first)
+		below = self.below_keys[bisect.bisect_right(self.below_prices, low):][::-1]
+		above = self.above_keys[:bisect.bisect_left(self.above_prices, high)]
+		return below + above
+
+
+	def clear(self):
+		self.below_prices, self.below_keys = [], []
+		self.above_prices, self.above_keys = [], []
+
+
+
+class AccountCache:
+
+	# Snapshot of the account (equity and cash), positions and last prices of an AlpacaBroker. Each part is fetched
+	# again once it is older than its ttl (in seconds), and fills from the trade update stream are applied to it in
+	# place, so in between the broker reads it without a round trip. Orders that have been submitted but not yet
+	# filled are kept in pending, so that an order placed right after another one takes it into account.
+	def __init__(self, api, account_ttl=5., position_ttl=5., quote_ttl=1.):
+		self.api = api
+		self.account_ttl = account_ttl
+		self.position_ttl = position_ttl
+		self.quote_ttl = quote_ttl
+		self.account = None
+		self.account_time = -math.inf
+		self.positions = None
+		self.positions_time = -math.inf
+		self.prices = {}
+		self.pending = {}
+		self.lock = threading.RLock()
+
+
+	def get_account(self):
+		with self.lock:
+			if time.monotonic() - self.account_time > self.account_ttl:
+				account_data = self.api.get_account()
+				self.account = {'value': float(account_data.equity), 'cash': float(account_data.cash)}
+				self.account_time = time.monotonic()
+			return dict(self.account)
+
+
+	def get_positions(self):
+		with self.lock:
+			if time.monotonic() - self.positions_time > self.position_ttl:
+				positions = {}
+				for entry in self.api.list_positions():
+					positions[entry.symbol] = {}
+					positions[entry.symbol]['amount'] = float(entry.qty)
+					positions[entry.symbol]['avg entry price'] = float(entry.avg_entry_price)
+					positions[entry.symbol]['price'] = float(entry.current_price)
+				self.positions = positions
+				self.positions_time = time.monotonic()
+			return {symbol: dict(position) for symbol, position in self.positions.items()}
+
+
+	def get_prices(self, symbols):
+		# Last trade prices, with the stale ones fetched in one request
+		with self.lock:
+			now = time.monotonic()
+			stale = [symbol for symbol in symbols if now - self.prices.get(symbol, (None, -math.inf))[1] > self.quote_ttl]
+			if len(stale) == 1:
+				self.prices[stale[0]] = (self.api.get_latest_trade(stale[0]).price, time.monotonic())
+			elif len(stale) > 1:
+				trades = self.api.get_latest_trades(stale)
+				self.prices.update({symbol: (trade.price, time.monotonic()) for symbol, trade in trades.items()})
+			return {symbol: self.prices[symbol][0] for symbol in symbols}
+
+
+	def pending_amount(self, symbol):
+		with self.lock:
+			return sum(amount for pending_symbol, amount in self.pending.values() if pending_symbol == symbol)
+
+
+	def add_pending(self, client_order_id, symbol, amount):
+		with self.lock:
+			self.pending[client_order_id] = (symbol, amount)
+
+
+	def remove_pending(self, client_order_id):
+		with self.lock:
+			self.pending.pop(client_order_id, None)
+
+
+	def invalidate(self):
+		with self.lock:
+			self.account_time = -math.inf
+			self.positions_time = -math.inf
+
+
+	def on_trade_update(self, event, client_order_id, symbol, side, qty=None, price=None, position_qty=None):
+		# A fill of qty shares at price moves their value between the cash and the position, so the equity stays
+		# the same. Orders that are done are dropped from pending, whether they were filled completely or not.
+		with self.lock:
+			if event in ('fill', 'partial_fill') and qty is not None and price is not None:
+				qty, price = float(qty), float(price)
+				amount = qty if side == 'buy' else -qty
+				if client_order_id in self.pending:
+					pending_symbol, remaining = self.pending[client_order_id]
+					self.pending[client_order_id] = (pending_symbol, remaining - amount)
+				if self.account is not None:
+					self.account['cash'] -= amount * price
+				if self.positions is not None:
+					position = self.positions.setdefault(symbol, {'amount': 0., 'avg entry price': price, 'price': price})
+					old_amount = position['amount']
+					position['amount'] = float(position_qty) if position_qty is not None else old_amount + amount
+					if position['amount'] == 0:
+						del self.positions[symbol]
+					else:
+						if old_amount * position['amount'] >= 0 and abs(position['amount']) > abs(old_amount):
+							position['avg entry price'] = (position['avg entry price'] * abs(old_amount) + price * qty) / abs(position['amount'])
+						position['price'] = price
+				self.prices[symbol] = (price, time.monotonic())
+			if event in ('fill', 'canceled', 'expired', 'rejected', 'replaced', 'done_for_day'):
+				self.pending.pop(client_order_id, None)
 
 
 
 class AlpacaBroker:
 
-	def __init__(self, paper=True):
-		self.api = get_api(paper)
+	# The account state is served from an AccountCache that the trade update stream (Alpaca's websocket by default,
+	# or any object with subscribe_trade_updates/run/stop) keeps up to date, so that placing an order usually takes
+	# a single request. api replaces the REST client, e.g. with a local mock of the trading API. Without the stream
+	# (trade_updates=False) the cache is cleared after every order instead.
+	# Orders and cancellations go through an OrderGateway, which sends them concurrently (max_workers requests at a
+	# time, at most max_in_flight orders waiting for the API). order_async returns its OrderTicket, and order waits for it.
+	def __init__(self, paper=True, api=None, stream=None, trade_updates=True, account_ttl=5., position_ttl=5., quote_ttl=1., max_workers=8, max_in_flight=32):
+		self.paper = paper
+		self.api = api if api is not None else get_api(paper)
 		self.start_date = datetime.datetime.now()
-		
+		self.cache = AccountCache(self.api, account_ttl=account_ttl, position_ttl=position_ttl, quote_ttl=quote_ttl)
+		self.gateway = OrderGateway(self.api, max_workers=max_workers, max_in_flight=max_in_flight, track=trade_updates)
+		self.stream = stream
+		self.streams = []
+		if trade_updates:
+			self.start_stream()
+
+
+	def start_stream(self):
+		stream = self.stream
+		if stream is None:
+			from alpaca.trading.stream import TradingStream
+			stream = TradingStream(get_creds("ALPACA_API_KEY"), get_creds("ALPACA_SECRET_KEY"), paper=self.paper)
+		stream.subscribe_trade_updates(self.on_trade_update)
+		thread = threading.Thread(target=stream.run, daemon=True)
+		thread.start()
+		self.streams.append((stream, thread))
+
+
+	def stop_stream(self):
+		for stream, thread in self.streams:
+			stream.stop()
+		self.streams = []
+
+
+	def stop(self):
+		# Stops the trade update stream, and waits for the orders that are being sent before stopping the gateway's threads
+		self.stop_stream()
+		self.gateway.shutdown()
+
+
+	async def on_trade_update(self, data):
+		order = data.order
+		client_order_id = str(order.client_order_id)
+		self.cache.on_trade_update(data.event, client_order_id, order.symbol, order.side, qty=data.qty, price=data.price, position_qty=data.position_qty)
+		self.gateway.on_trade_update(data.event, client_order_id, order, qty=data.qty, price=data.price)
+
 
 	def order(self, symbol, amount, limit=None, stop=None, price=None, time=datetime.datetime.now()):
+		ticket = self.order_async(symbol=symbol, amount=amount, limit=limit, stop=stop, price=price)
+		if ticket is not None:
+			return ticket.submitted.result()
+
+
+	def order_async(self, symbol, amount, limit=None, stop=None, price=None, client_order_id=None):
+		# Sends the order without waiting for the API, and returns its OrderTicket (None if amount is 0).
+		# Sending the same client_order_id again does not place a second order.
+		params = self.order_params(symbol, amount, limit, stop, price)
+		if params is None:
+			return None
+		if client_order_id is None:
+			client_order_id = uuid.uuid4().hex
+		elif client_order_id in self.gateway.tickets:
+			return self.gateway.tickets[client_order_id]
+		if len(self.streams) > 0:
+			# With the stream, the order counts as pending until its fills arrive
+			self.cache.add_pending(client_order_id, symbol, amount)
+		return self.gateway.submit(client_order_id=client_order_id, callback=self.submitted, **params)
+
+
+	def submitted(self, ticket, error):
+		if error is not None:
+			self.cache.remove_pending(ticket.client_order_id)
+		if len(self.streams) == 0:
+			self.cache.invalidate()
+
+
+	def order_params(self, symbol, amount, limit=None, stop=None, price=None):
+		# The arguments of api.submit_order for the order (None if amount is 0).
 		# stop < 0: stop loss. stop > 0 take gain. if it is a buy order, then it places the stop order after the buy is filled
-		price = self.quote(symbol)
+		if price is None and (limit is not None or stop is not None):
+			price = self.quote(symbol)
 		order_type = 'market'
 		limit_price = None
 		if stop is not None:
@@ -172,38 +559,66 @@ class AlpacaBroker:
 			order_type = 'limit'
 		if amount > 0:
 			if stop is None:
-				orderid = self.api.submit_order(symbol=symbol, side='buy', type=order_type, limit_price=limit_price, qty=str(amount), time_in_force='day')
+				return dict(symbol=symbol, side='buy', type=order_type, limit_price=limit_price, qty=str(amount), time_in_force='day')
 			else:
 				if stop_price > price:
-					orderid = self.api.submit_order(symbol=symbol, side='buy', type=order_type, limit_price=limit_price, qty=str(amount), time_in_force='gtc', order_class='oto', take_profit={'limit_price': stop_price})
+					return dict(symbol=symbol, side='buy', type=order_type, limit_price=limit_price, qty=str(amount), time_in_force='gtc', order_class='oto', take_profit={'limit_price': stop_price})
 				else:
-					orderid = self.api.submit_order(symbol=symbol, side='buy', type=order_type, limit_price=limit_price, qty=str(amount), time_in_force='gtc', order_class='oto', stop_loss={'stop_price': stop_price})
-			return orderid
+					return dict(symbol=symbol, side='buy', type=order_type, limit_price=limit_price, qty=str(amount), time_in_force='gtc', order_class='oto', stop_loss={'stop_price': stop_price})
 		elif amount < 0:
 			if stop is None:
-				orderid = self.api.submit_order(symbol=symbol, side='sell', type=order_type, limit_price=limit_price, qty=str(abs(amount)), time_in_force='day')
+				return dict(symbol=symbol, side='sell', type=order_type, limit_price=limit_price, qty=str(abs(amount)), time_in_force='day')
 			else:
 				if stop_price > price:
-					orderid = self.api.submit_order(symbol=symbol, side='sell', type='limit', qty=str(abs(amount)), time_in_force='gtc', order_class='oco', take_profit={'limit_price': stop_price}, stop_loss={'stop_price': 0})
+					return dict(symbol=symbol, side='sell', type='limit', qty=str(abs(amount)), time_in_force='gtc', order_class='oco', take_profit={'limit_price': stop_price}, stop_loss={'stop_price': 0})
 				else:
-					orderid = self.api.submit_order(symbol=symbol, side='sell', type='limit', qty=str(abs(amount)), time_in_force='gtc', order_class='oco', take_profit={'limit_price': 100*price}, stop_loss={'stop_price': stop_price})
-			return orderid
+					return dict(symbol=symbol, side='sell', type='limit', qty=str(abs(amount)), time_in_force='gtc', order_class='oco', take_profit={'limit_price': 100*price}, stop_loss={'stop_price': stop_price})
+		return None
 
 
 	def order_target_percent(self, symbol, percent, limit=None, stop=None, time=datetime.datetime.now()):
 		account_value = self.get_value()['value']
 		positions = self.get_positions(time=time)
-		current_amount = positions[symbol]['amount'] if (symbol in positions) else 0
+		current_amount = (positions[symbol]['amount'] if (symbol in positions) else 0) + self.cache.pending_amount(symbol)
 		price = positions[symbol]['price'] if (symbol in positions) else self.quote(symbol)
 		desired_amount = math.floor(account_value * percent / price)
 		diff = desired_amount - current_amount
-		self.order(symbol=symbol, amount=diff, limit=limit, stop=stop, time=time)
+		self.order(symbol=symbol, amount=diff, limit=limit, stop=stop, price=price, time=time)
+
 
 
+	def rebalance(self, weights, limit=None, stop=None, time=datetime.datetime.now(), timeout=60.):
+		# One account snapshot, one positions call and one batched quote request for the whole basket.
+		# All the sells are sent at once, and once they are filled (or timeout seconds have passed) the buys
+		# are sent at once, so that the cash from the sells is there to pay for them.
+		weights = pd.Series(weights, dtype=np.float64)
+		if (weights > 1).any() or (weights < 0).any() or weights.sum() > 1 + 1e-9:
+			print("Rebalance Failed. The target weights must be between 0 and 1, and sum to at most 1, \
+					but you entered {weights}.".format(weights=weights.to_dict()))
+			return
+		account_value = self.get_value()['value']
+		positions = self.get_positions(time=time)
+		prices = {symbol: positions[symbol]['price'] for symbol in weights.index if symbol in positions}
+		prices.update(self.quotes([symbol for symbol in weights.index if symbol not in positions]))
+		prices = np.array([prices[symbol] for symbol in weights.index])
+		current = np.array([(positions[symbol]['amount'] if symbol in positions else 0) + self.cache.pending_amount(symbol) for symbol in weights.index])
+		diffs = np.floor(account_value * weights.values / prices) - current
+		sells = [self.order_async(symbol=weights.index[order_idx], amount=int(diffs[order_idx]), limit=limit, stop=stop, price=prices[order_idx]) for order_idx in np.flatnonzero(diffs < 0)]
+		unfilled = self.gateway.wait_done(sells, timeout=timeout)
+		if len(unfilled) > 0:
+			print("Rebalance: {count} sell orders were not filled after {timeout} seconds, the buys may lack buying power.".format(count=len(unfilled), timeout=timeout))
+		buys = [self.order_async(symbol=weights.index[order_idx], amount=int(diffs[order_idx]), limit=limit, stop=stop, price=prices[order_idx]) for order_idx in np.flatnonzero(diffs > 0)]
+		self.gateway.wait(buys)
+
 
 	def quote(self, symbol):
-		price = self.api.get_last_trade(symbol).price
-		return price
+		return self.cache.get_prices([symbol])[symbol]
+
+
+	def quotes(self, symbols):
+		if len(symbols) == 0:
+			return {}
+		return self.cache.get_prices(symbols)
 
 
 
@@ -221,31 +636,17 @@ class AlpacaBroker:
 
 
 	def get_positions(self, time=datetime.datetime.now()):
-		positions = {}
-		position_data = self.api.list_positions()
-		for entry in position_data:
-			positions[entry.symbol] = {}
-			positions[entry.symbol]['amount'] = float(entry.qty)
-			positions[entry.symbol]['avg entry price'] = float(entry.avg_entry_price)
-			positions[entry.symbol]['price'] = float(entry.current_price)
-		return positions
+		return self.cache.get_positions()
 
 
 	def get_value(self, time=datetime.datetime.now()):
-		account = {}
-		account_data = self.api.get_account()
-		account['value'] = float(account_data.equity)
-		account['cash'] = float(account_data.cash)
-		return account
+		return self.cache.get_account()
 
 
 	def cancel_orders(self, symbol=None):
-		if symbol is None:
-			self.api.cancel_all_orders()
-		else:
-			orders = list(filter(lambda order: order.symbol==symbol, self.api.list_orders()))
-			for order in orders:
-				self.api.cancel_order(order.id)
+		self.gateway.cancel_all(symbol)
+		if len(self.streams) == 0:
+			self.cache.invalidate()
 
 
 
@@ -0,0 +1,183 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+import requests
+import alpaca_trade_api as tradeapi
+from alpaca.data.historical import CryptoHistoricalDataClient, StockHistoricalDataClient
+from AlgoTrader.Util import get_creds
+
+
+class RateLimiter:
+
+	# Token bucket shared by every request to Alpaca: tokens refill at rate per second up to capacity, and each
+	# request takes one. Requests that find the bucket empty wait in line by priority (lower first, so orders go
+	# before data), then in the order they arrived. Keeps per priority the number of requests, how many of them
+	# had to wait (throttled), and their total and largest waiting time in seconds.
+	def __init__(self, rate=200/60, capacity=10):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+		self.waiting = []
+		self.counter = itertools.count()
+		self.condition = threading.Condition()
+		self.stats = {}
+
+
+	def acquire(self, priority=0):
+		start = time.monotonic()
+		with self.condition:
+			entry = (priority, next(self.counter))
+			heapq.heappush(self.waiting, entry)
+			while True:
+				self.refill()
+				if self.waiting[0] == entry and self.tokens >= 1:
+					break
+				timeout = None if self.waiting[0] != entry else (1 - self.tokens) / self.rate
+				self.condition.wait(timeout)
+			heapq.heappop(self.waiting)
+			self.tokens -= 1
+			self.condition.notify_all()
+			delay = time.monotonic() - start
+			stats = self.stats.setdefault(priority, {'requests': 0, 'throttled': 0, 'wait': 0., 'max wait': 0.})
+			stats['requests'] += 1
+			stats['throttled'] += int(delay > 1e-3)
+			stats['wait'] += delay
+			stats['max wait'] = max(stats['max wait'], delay)
+		return delay
+
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+
+
+class LimitedSession(requests.Session):
+
+	# The HTTP session of a client from the registry. Every request, including each page of a paginated call, waits
+	# for a token from the shared limiter. Responses that are rate limited (429) or failed on the server (5xx), and
+	# requests that fail to connect, are retried up to max_retries times after a random wait of up to
+	# backoff * 2**attempt seconds (at most max_backoff).
+	def __init__(self, registry, priority):
+		super().__init__()
+		self.registry = registry
+		self.priority = priority
+
+
+	def request(self, method, url, *args, **kwargs):
+		registry = self.registry
+		attempt = 0
+		while True:
+			registry.limiter.acquire(self.priority)
+			try:
+				response = super().request(method, url, *args, **kwargs)
+				status = response.status_code
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt >= registry.max_retries:
+					registry.count('failures')
+					raise
+				response = None
+				status = None
+			if response is not None:
+				if status == 429:
+					registry.count('rate limited')
+				if status != 429 and status < 500:
+					return response
+				if attempt >= registry.max_retries:
+					registry.count('failures')
+					return response
+			registry.count('retries')
+			time.sleep(random.uniform(0, min(registry.max_backoff, registry.backoff * 2**attempt)))
+			attempt += 1
+
+
+
+class ClientRegistry:
+
+	# One client per kind of Alpaca API and set of credentials for the whole process, so that their HTTP sessions
+	# stay open and are reused. They all share one RateLimiter, in which trading requests go before data requests.
+	priorities = {'order': 0, 'data': 1}
+
+	def __init__(self, rate=200/60, capacity=10, max_retries=5, backoff=0.5, max_backoff=30.):
+		self.limiter = RateLimiter(rate=rate, capacity=capacity)
+		self.max_retries = max_retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.clients = {}
+		self.lock = threading.Lock()
+		self.counts = {'retries': 0, 'rate limited': 0, 'failures': 0}
+
+
+	def get_client(self, key, factory, priority):
+		with self.lock:
+			if key not in self.clients:
+				client = factory()
+				client._session = LimitedSession(self, ClientRegistry.priorities[priority])
+				# The session does the retrying, with a fresh token for each attempt
+				client._retry = 0
+				self.clients[key] = client
+			return self.clients[key]
+
+
+	def trading_api(self, paper=True, api_key=None, secret_key=None):
+		api_key, secret_key = self.credentials(api_key, secret_key)
+		base_url = "https://paper-api.alpaca.markets" if paper else "https://api.alpaca.markets"
+		return self.get_client(('trading', paper, api_key), lambda: tradeapi.REST(api_key, secret_key, base_url=base_url, api_version='v2'), 'order')
+
+
+	def data_client(self, is_crypto=False, api_key=None, secret_key=None):
+		api_key, secret_key = self.credentials(api_key, secret_key)
+		if is_crypto:
+			return self.get_client(('crypto',), lambda: CryptoHistoricalDataClient(), 'data')
+		return self.get_client(('stock', api_key), lambda: StockHistoricalDataClient(api_key, secret_key), 'data')
+
+
+	def news_client(self, api_key=None, secret_key=None):
+		api_key, secret_key = self.credentials(api_key, secret_key)
+		return self.get_client(('news', api_key), lambda: tradeapi.REST(api_key, secret_key, base_url="https://api.alpaca.markets", api_version='v2'), 'data')
+
+
+	def credentials(self, api_key, secret_key):
+		if api_key is None:
+			api_key = get_creds("ALPACA_API_KEY")
+		if secret_key is None:
+			secret_key = get_creds("ALPACA_SECRET_KEY")
+		return api_key, secret_key
+
+
+	def count(self, name):
+		with self.lock:
+			self.counts[name] += 1
+
+
+	def metrics(self):
+		# Queueing delay and throttling per kind of traffic, and the retry counts
+		names = {priority: name for name, priority in ClientRegistry.priorities.items()}
+		with self.limiter.condition:
+			metrics = {names.get(priority, priority): dict(stats) for priority, stats in self.limiter.stats.items()}
+		for stats in metrics.values():
+			stats['mean wait'] = stats['wait'] / stats['requests'] if stats['requests'] > 0 else 0.
+		with self.lock:
+			metrics.update(self.counts)
+		return metrics
+
+
+
+registry = None
+registry_lock = threading.Lock()
+
+def get_registry(**kwargs):
+	# The process-wide ClientRegistry. kwargs (see ClientRegistry) only apply when it is first created.
+	global registry
+	with registry_lock:
+		if registry is None:
+			registry = ClientRegistry(**kwargs)
+		return registry
+
+
+def get_api(paper=True):
+	return get_registry().trading_api(paper)
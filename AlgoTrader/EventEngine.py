@@ -0,0 +1,67 @@
+import heapq
+import numpy as np
+from AlgoTrader.Schedule import schedule_stream
+from AlgoTrader.Util import to_ns, ns_to_datetime
+
+
+BAR = 0
+SCHEDULE = 1
+LOG = 2
+
+
+def bar_stream(prices, start, end):
+	# Yields (time, bar index) for every bar of the price store in [start, end)
+	first = np.searchsorted(prices.times, to_ns(start), side='left')
+	last = np.searchsorted(prices.times, to_ns(end), side='left')
+	for idx in range(first, last):
+		yield prices.times[idx], idx
+
+
+def time_stream(times):
+	for time in times:
+		yield time.astype(np.int64), None
+
+
+class EventEngine:
+
+	# Event-driven backtest. Bars are streamed from the price store and merged with the fire times of
+	# each algo and of the logger in a priority queue, which holds at most one pending event per source.
+	# Fire times are compiled one window at a time, so memory does not grow with the length of the backtest. At equal times bars are processed
+	# before schedules, and schedules before logging.
+	def __init__(self, manager):
+		self.manager = manager
+		self.queue = []
+
+
+	def push(self, source, kind, idx):
+		event = next(source, None)
+		if event is not None:
+			time, payload = event
+			heapq.heappush(self.queue, (time, kind, idx, payload, source))
+
+
+	def run(self, start, end, log_schedule):
+		manager = self.manager
+		broker = manager.broker
+		prices = manager.data.prices
+		benchmark_idx = prices.symbol_idx[manager.benchmark]
+		broker.set_bar(np.searchsorted(prices.times, to_ns(start), side='left') - 1)
+		self.push(bar_stream(prices, start, end), BAR, 0)
+		for idx, algo in enumerate(manager.algos):
+			self.push(time_stream(schedule_stream(algo.schedule, start, end)), SCHEDULE, idx)
+		self.push(time_stream(schedule_stream(log_schedule, start, end)), LOG, 0)
+		while len(self.queue) > 0:
+			time, kind, idx, payload, source = heapq.heappop(self.queue)
+			self.push(source, kind, idx)
+			manager.datetime = ns_to_datetime(time)
+			if kind == BAR:
+				broker.set_bar(payload)
+				broker.fill_pending(time=manager.datetime)
+				broker.check_limit_orders(time=manager.datetime)
+				for algo in manager.algos:
+					algo.bar_wrapper(time=manager.datetime)
+			elif kind == SCHEDULE:
+				manager.algos[idx].run_wrapper(time=manager.datetime, update=False)
+			elif kind == LOG and broker.bar >= 0:
+				manager.logger.append(broker.get_value(manager.datetime)['value'], manager.datetime)
+				manager.logger.append(broker.get_quotes(manager.datetime)[benchmark_idx], manager.datetime, benchmark=True)
@@ -0,0 +1,244 @@
+import copy
+import math
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+class Indicator:
+
+	# Base class of the indicators that Algo.add_indicator keeps up to date. An indicator is fed the bars of
+	# one symbol and datatype as the clock advances, either one at a time through update (O(1) per bar), or,
+	# with precompute=True, by evaluating compute over the whole series once and looking values up by index.
+	# value holds the indicator at the last visible bar (NaN until enough bars have been seen).
+	# Missing bars (NaN) are skipped. The definitions follow the ta package.
+	# Bars that may still change (the bar a live stream is filling in) are only applied to a copy of the state,
+	# so that they are applied again with their final values once they are complete.
+	def __init__(self):
+		self.symbol = None
+		self.datatype = None
+		self.timeframe = None
+		self.precompute = False
+		self.reset()
+
+
+	def bind(self, symbol, datatype, precompute=False, timeframe=None):
+		self.symbol = symbol
+		self.datatype = datatype
+		self.timeframe = timeframe
+		self.precompute = precompute
+		self.reset()
+
+
+	def reset(self):
+		self.position = 0
+		self.values = None
+		self.value = math.nan
+		self.settled_value = math.nan
+		self.reset_state()
+
+
+	def feed(self, series, end, complete=None):
+		# series is the full series of the symbol, series[:end] are the bars that can be seen now, and
+		# series[:complete] (all of them by default) are the bars that will not change anymore
+		complete = end if complete is None else min(complete, end)
+		if complete < self.position:
+			self.reset()
+		if self.precompute:
+			if self.values is None or len(self.values) < end or complete < end:
+				self.values = self.compute_series(series)
+			self.value = self.values[end-1] if end > 0 else math.nan
+		else:
+			for x in series[self.position:complete].tolist():
+				if x == x:
+					self.settled_value = self.update(x)
+			self.value = self.settled_value
+			if complete < end:
+				provisional = copy.deepcopy(self)
+				for x in series[complete:end].tolist():
+					if x == x:
+						self.value = provisional.update(x)
+		self.position = complete
+		return self.value
+
+
+	def compute_series(self, series):
+		# compute over the bars that exist, with the last value carried over the missing ones
+		series = np.asarray(series, dtype=np.float64)
+		valid = ~np.isnan(series)
+		values = np.full(len(series), np.nan)
+		values[valid] = self.compute(series[valid])
+		last = np.maximum.accumulate(np.where(valid, np.arange(len(series)), -1))
+		values = np.where(last >= 0, values[np.maximum(last, 0)], np.nan)
+		return values
+
+
+	def reset_state(self):
+		pass
+
+	def update(self, x):
+		raise NotImplementedError
+
+	def compute(self, values):
+		raise NotImplementedError
+
+
+
+class EMA(Indicator):
+
+	def __init__(self, window=14):
+		self.window = window
+		self.alpha = 2 / (window + 1)
+		super().__init__()
+
+
+	def reset_state(self):
+		self.ema = math.nan
+		self.count = 0
+
+
+	def update(self, x):
+		self.ema = x if self.count == 0 else self.ema + self.alpha * (x - self.ema)
+		self.count += 1
+		return self.ema if self.count >= self.window else math.nan
+
+
+	def compute(self, values):
+		return pd.Series(values).ewm(span=self.window, min_periods=self.window, adjust=False).mean().to_numpy()
+
+
+
+class MACD(Indicator):
+
+	# value is the MACD histogram (ta.trend.macd_diff), and macd and signal hold the two lines
+	def __init__(self, window_slow=26, window_fast=12, window_sign=9):
+		self.window_slow = window_slow
+		self.window_fast = window_fast
+		self.window_sign = window_sign
+		super().__init__()
+
+
+	def reset_state(self):
+		self.fast = EMA(self.window_fast)
+		self.slow = EMA(self.window_slow)
+		self.signal_ema = EMA(self.window_sign)
+		self.macd = math.nan
+		self.signal = math.nan
+
+
+	def update(self, x):
+		fast = self.fast.update(x)
+		slow = self.slow.update(x)
+		self.macd = fast - slow
+		if self.macd == self.macd:
+			self.signal = self.signal_ema.update(self.macd)
+		return self.macd - self.signal
+
+
+	def compute(self, values):
+		values = pd.Series(values)
+		macd = values.ewm(span=self.window_fast, min_periods=self.window_fast, adjust=False).mean() - values.ewm(span=self.window_slow, min_periods=self.window_slow, adjust=False).mean()
+		signal = macd.ewm(span=self.window_sign, min_periods=self.window_sign, adjust=False).mean()
+		return (macd - signal).to_numpy()
+
+
+
+class RSI(Indicator):
+
+	def __init__(self, window=14):
+		self.window = window
+		super().__init__()
+
+
+	def reset_state(self):
+		self.last = 0.
+		self.up = 0.
+		self.down = 0.
+		self.count = 0
+
+
+	def update(self, x):
+		# As in ta, the first bar counts as a move of 0
+		diff = 0. if self.count == 0 else x - self.last
+		self.last = x
+		up, down = max(diff, 0.), max(-diff, 0.)
+		self.up += (up - self.up) / self.window
+		self.down += (down - self.down) / self.window
+		self.count += 1
+		if self.count < self.window:
+			return math.nan
+		if self.down == 0:
+			return 100.
+		return 100 - 100 / (1 + self.up / self.down)
+
+
+	def compute(self, values):
+		diff = pd.Series(values).diff(1)
+		up = diff.where(diff > 0, 0.).ewm(alpha=1/self.window, min_periods=self.window, adjust=False).mean()
+		down = (-diff.where(diff < 0, 0.)).ewm(alpha=1/self.window, min_periods=self.window, adjust=False).mean()
+		with np.errstate(divide='ignore', invalid='ignore'):
+			return np.where(down == 0, 100., 100 - 100 / (1 + up / down))
+
+
+
+class RollingMean(Indicator):
+
+	def __init__(self, window=20):
+		self.window = window
+		super().__init__()
+
+
+	def reset_state(self):
+		# The last window values are kept in a ring buffer, and their mean and sum of squared
+		# deviations (Welford) are updated as one value enters and the oldest one leaves
+		self.buffer = np.zeros(self.window)
+		self.count = 0
+		self.mean = 0.
+		self.m2 = 0.
+
+
+	def add(self, x):
+		idx = self.count % self.window
+		if self.count < self.window:
+			delta = x - self.mean
+			self.mean += delta / (self.count + 1)
+			self.m2 += delta * (x - self.mean)
+		else:
+			old = self.buffer[idx]
+			mean = self.mean + (x - old) / self.window
+			self.m2 += (x - old) * (x - mean + old - self.mean)
+			self.mean = mean
+		self.buffer[idx] = x
+		self.count += 1
+
+
+	def update(self, x):
+		self.add(x)
+		return self.mean if self.count >= self.window else math.nan
+
+
+	def compute(self, values):
+		means = np.full(len(values), np.nan)
+		if len(values) >= self.window:
+			means[self.window-1:] = sliding_window_view(values, self.window).mean(axis=1)
+		return means
+
+
+
+class RollingVar(RollingMean):
+
+	def __init__(self, window=20, ddof=1):
+		self.ddof = ddof
+		super().__init__(window)
+
+
+	def update(self, x):
+		self.add(x)
+		return max(self.m2, 0.) / (self.window - self.ddof) if self.count >= self.window else math.nan
+
+
+	def compute(self, values):
+		variances = np.full(len(values), np.nan)
+		if len(values) >= self.window:
+			variances[self.window-1:] = sliding_window_view(values, self.window).var(axis=1, ddof=self.ddof)
+		return variances
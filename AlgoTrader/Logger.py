@@ -1,53 +1,173 @@
+import os
+import math
+import shutil
+import weakref
+import tempfile
 import pandas as pd
 import numpy as np
-import quantstats as qs
+from AlgoTrader.Util import to_ns
+from AlgoTrader.Metrics import compute_metrics
 
 class Logger:
 
-	def __init__(self):
-		self.value = []
-		self.benchmark = []
-		self.value_times = []
-		self.benchmark_times = []
+	def __init__(self, chunk_size=4096, spill_dir=None):
+		self.value = LogBuffer(chunk_size=chunk_size, spill_dir=spill_dir, name="value")
+		self.benchmark = LogBuffer(chunk_size=chunk_size, spill_dir=spill_dir, name="benchmark")
+		self.value_stats = RunningStats()
+		self.benchmark_stats = RunningStats()
 		self.returns = None
 		self.benchmark_returns = None
 
 	def append(self, val, time, benchmark=False):
 		if benchmark:
-			self.benchmark.append(val)
-			self.benchmark_times.append(pd.Timestamp(time))
+			self.benchmark.append(val, to_ns(time))
+			self.benchmark_stats.update(val)
 		else:
-			self.value.append(val)
-			self.value_times.append(pd.Timestamp(time))
+			self.value.append(val, to_ns(time))
+			self.value_stats.update(val)
 
 	def calc_returns(self):
-		self.value = np.array(self.value)
-		self.benchmark = np.array(self.benchmark)
-		self.returns = (self.value[1:] / self.value[:-1]) - 1
-		self.benchmark_returns = (self.benchmark[1:] / self.benchmark[:-1]) - 1
-		self.returns = pd.Series(self.returns, index=pd.Index(self.value_times[1:]), name="Algo")
-		self.benchmark_returns = pd.Series(self.benchmark_returns, index=pd.Index(self.benchmark_times[1:]), name="Benchmark")
+		value_times, value = self.value.arrays()
+		benchmark_times, benchmark = self.benchmark.arrays()
+		returns = (value[1:] / value[:-1]) - 1
+		benchmark_returns = (benchmark[1:] / benchmark[:-1]) - 1
+		self.returns = pd.Series(returns, index=pd.DatetimeIndex(value_times[1:].view('datetime64[ns]')), name="Algo")
+		self.benchmark_returns = pd.Series(benchmark_returns, index=pd.DatetimeIndex(benchmark_times[1:].view('datetime64[ns]')), name="Benchmark")
 
 
 	def report(self, filename="report.html"):
-		if self.returns is None:
-			self.calc_returns()
+		self.calc_returns()
+		# quantstats (and the plotting stack under it) is only imported when a report is made
+		import quantstats as qs
 		qs.reports.html(self.returns, self.benchmark_returns, output=filename)
 
-		
-	def metrics(self):
+
+	def running_metrics(self):
+		# O(1) metrics from the running accumulators, which can be queried at any point of a backtest or live run
 		metrics = {}
-		if self.returns is None:
-			self.calc_returns()
-		metrics['sharpe'] = qs.stats.sharpe(self.returns)
-		metrics['sortino'] = qs.stats.sortino(self.returns)
-		greeks = qs.stats.greeks(self.returns, self.benchmark_returns)
-		metrics['alpha'] = greeks['alpha']
-		metrics['beta'] = greeks['beta']
-		metrics['cagr'] = qs.stats.cagr(self.returns)
-		metrics['max drawdown'] = qs.stats.max_drawdown(self.returns)
-		metrics['avg win'] = qs.stats.avg_win(self.returns)
-		metrics['avg loss'] = qs.stats.avg_loss(self.returns)
-		metrics['win rate'] = qs.stats.win_rate(self.returns)
-		metrics['total return'] = qs.stats.comp(self.returns)
-		return metrics
\ No newline at end of file
+		metrics['sharpe'] = self.value_stats.sharpe()
+		metrics['max drawdown'] = self.value_stats.max_drawdown
+		metrics['total return'] = self.value_stats.total_return()
+		metrics['benchmark total return'] = self.benchmark_stats.total_return()
+		return metrics
+
+
+	def metrics(self):
+		self.calc_returns()
+		return compute_metrics(self.returns.to_numpy(), self.benchmark_returns.to_numpy())
+
+
+	def close(self):
+		self.value.close()
+		self.benchmark.close()
+
+
+
+class LogBuffer:
+
+	# Append-only log of (int64 time, float64 value) pairs. Values are written into a preallocated chunk,
+	# and full chunks are either kept in memory or, if spill_dir is given, written to disk in a directory
+	# of their own under it, so that buffers sharing a spill_dir never overwrite each other's chunks.
+	# That directory is removed by close, or when the buffer is garbage collected.
+	def __init__(self, chunk_size=4096, spill_dir=None, name="value"):
+		self.chunk_size = chunk_size
+		self.spill_dir = spill_dir
+		self.name = name
+		self.chunks = []
+		self.times = np.empty(chunk_size, dtype=np.int64)
+		self.values = np.empty(chunk_size, dtype=np.float64)
+		self.size = 0
+		self.count = 0
+		if spill_dir is not None:
+			os.makedirs(spill_dir, exist_ok=True)
+			self.spill_dir = tempfile.mkdtemp(prefix=name + "_", dir=spill_dir)
+			self.finalizer = weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+
+
+	def __len__(self):
+		return self.count
+
+
+	def append(self, value, time):
+		self.times[self.size] = time
+		self.values[self.size] = value
+		self.size += 1
+		self.count += 1
+		if self.size == self.chunk_size:
+			self.flush()
+
+
+	def flush(self):
+		if self.size == 0:
+			return
+		if self.spill_dir is not None:
+			path = os.path.join(self.spill_dir, "{name}_{idx}.npz".format(name=self.name, idx=len(self.chunks)))
+			np.savez(path, times=self.times[:self.size], values=self.values[:self.size])
+			self.chunks.append(path)
+		else:
+			self.chunks.append((self.times[:self.size], self.values[:self.size]))
+			self.times = np.empty(self.chunk_size, dtype=np.int64)
+			self.values = np.empty(self.chunk_size, dtype=np.float64)
+		self.size = 0
+
+
+	def arrays(self):
+		times, values = [], []
+		for chunk in self.chunks:
+			if isinstance(chunk, str):
+				with np.load(chunk) as f:
+					chunk = (f['times'], f['values'])
+			times.append(chunk[0])
+			values.append(chunk[1])
+		times.append(self.times[:self.size])
+		values.append(self.values[:self.size])
+		return np.concatenate(times), np.concatenate(values)
+
+
+	def close(self):
+		# Deletes the spilled chunks, so only the values that are still in memory are kept
+		if self.spill_dir is not None:
+			self.finalizer()
+			self.chunks = []
+			self.count = self.size
+
+
+
+class RunningStats:
+
+	# Return, drawdown and Sharpe accumulators for a value series, updated in O(1) per value
+	def __init__(self):
+		self.first = None
+		self.last = None
+		self.peak = None
+		self.max_drawdown = 0.
+		self.count = 0
+		self.mean = 0.
+		self.m2 = 0.
+
+
+	def update(self, value):
+		if self.last is None:
+			self.first = value
+			self.peak = value
+		else:
+			ret = value / self.last - 1
+			self.count += 1
+			delta = ret - self.mean
+			self.mean += delta / self.count
+			self.m2 += delta * (ret - self.mean)
+		self.last = value
+		self.peak = max(self.peak, value)
+		self.max_drawdown = min(self.max_drawdown, value / self.peak - 1)
+
+
+	def sharpe(self, periods=252):
+		if self.count < 2 or self.m2 == 0:
+			return float('nan')
+		return self.mean / math.sqrt(self.m2 / (self.count - 1)) * math.sqrt(periods)
+
+
+	def total_return(self):
+		if self.first is None:
+			return float('nan')
+		return self.last / self.first - 1
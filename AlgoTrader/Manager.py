@@ -1,13 +1,45 @@
 import datetime
 import pytz
 import code
+import io
+import shutil
+import tempfile
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.combining import OrTrigger
 from apscheduler.schedulers.background import BackgroundScheduler
 from AlgoTrader.AlpacaData import AlpacaData
-from AlgoTrader.Broker import BacktestBroker, AlpacaBroker
+from AlgoTrader.Broker import BacktestBroker, EventBroker, AlpacaBroker
 from AlgoTrader.Logger import Logger
-from AlgoTrader.Util import next_runtime, equals_runtime, convert_trigger_timezone, build_trigger, trading_day_offset
+from AlgoTrader.Util import convert_trigger_timezone, build_trigger, trading_day_offset, get_calendar
+from AlgoTrader.Schedule import compile_schedules
+from AlgoTrader.EventEngine import EventEngine
+
+
+worker_data = None
+worker_benchmark = None
+
+def init_backtest_worker(directory, benchmark):
+	global worker_data, worker_benchmark
+	worker_data = AlpacaData.load(directory)
+	worker_benchmark = benchmark
+
+
+def run_backtest_worker(algo_factory, params, backtest_kwargs):
+	return run_backtest(worker_data, worker_benchmark, algo_factory, params, backtest_kwargs)
+
+
+def run_backtest(data, benchmark, algo_factory, params, backtest_kwargs):
+	manager = Manager(data)
+	manager.benchmark = benchmark
+	manager.add_algo(algo_factory(**params))
+	with contextlib.redirect_stdout(io.StringIO()):
+		metrics = manager.backtest(report=False, **backtest_kwargs)
+	return metrics, manager.logger.returns
 
 
 class Manager:
@@ -26,8 +58,10 @@ class Manager:
 		self.jobs = {}
 	
 
-	def init_broker(self, backtest=False, **kwargs):
-		if backtest:
+	def init_broker(self, backtest=False, event=False, **kwargs):
+		if backtest and event:
+			self.broker = EventBroker(**kwargs)
+		elif backtest:
 			self.broker = BacktestBroker(**kwargs)
 		else:
 			self.broker = AlpacaBroker(**kwargs)
@@ -70,32 +104,129 @@ class Manager:
 		algo.run_wrapper(time=self.datetime, update=True)
 
 
-	def backtest(self, start=datetime.datetime(2022,9,1), end=datetime.datetime.now(), log_schedule=[{"minute": "30", "hour": "13", "day_of_week": "mon-fri"}]):
-		self.init_broker(backtest=True, data=self.data)
-		log_trigger = build_trigger(log_schedule)
-		algo_trigger = OrTrigger([algo.trigger for algo in self.algos])
-		trigger = OrTrigger([algo_trigger, log_trigger])
-		logging = isinstance(log_schedule, dict) or len(log_schedule) > 0
+	def backtest(self, start=datetime.datetime(2022,9,1), end=datetime.datetime.now(), log_schedule=[{"minute": "30", "hour": "13", "day_of_week": "mon-fri"}], engine='schedule', report=True):
+		# engine='schedule' steps through the fire times of the algos and asks the data what the price was at each one.
+		# engine='event' streams the bars through an event queue, calls each algo's on_bar as well as its
+		# scheduled run, and fills orders at the open of the next bar.
 		if isinstance(start, int) and not isinstance(end, int):
 			start = trading_day_offset(end, -start)
 		if not isinstance(start, int) and isinstance(end, int):
 			end = trading_day_offset(start, end)
-		self.datetime = start
-		while self.datetime < end:
-			for algo in self.algos:
-				if equals_runtime(algo.trigger, self.datetime):
-					self.broker.check_limit_orders(time=self.datetime)
-					algo.run_wrapper(time=self.datetime, update=False)
-			if logging and equals_runtime(log_trigger, self.datetime):
-				self.log_state()
-			self.datetime = next_runtime(trigger, self.datetime)
+		if engine == 'event':
+			self.init_broker(backtest=True, event=True, data=self.data)
+			EventEngine(self).run(start, end, log_schedule)
+		elif engine == 'schedule':
+			self.init_broker(backtest=True, data=self.data)
+			self.run_schedule(start, end, log_schedule)
+		else:
+			raise ValueError(f"engine {engine} not recognised.")
 		metrics = self.logger.metrics()
-		for metric, value in metrics.items():
-			print("{metric}: {value:.3f}".format(metric=metric, value=value))
-		self.logger.report()
+		if report:
+			for metric, value in metrics.items():
+				print("{metric}: {value:.3f}".format(metric=metric, value=value))
+			self.logger.report()
 		return metrics
 
 
+	def sweep(self, algo_factory, param_grid, start=datetime.datetime(2022,9,1), end=datetime.datetime.now(), log_schedule=[{"minute": "30", "hour": "13", "day_of_week": "mon-fri"}], engine='schedule', processes=None, should_stop=None):
+		# Backtests algo_factory(**params) for every combination of parameters in param_grid (a dict of lists,
+		# or a list of dicts) on a pool of processes, and returns a DataFrame with the params and metrics of each run.
+		# should_stop(results) is called with the results so far after every run, and cancels the remaining
+		# runs if it returns True. Interrupting the sweep also returns the results so far.
+		if isinstance(param_grid, dict):
+			param_grid = [dict(zip(param_grid.keys(), values)) for values in itertools.product(*param_grid.values())]
+		if isinstance(start, int) and not isinstance(end, int):
+			start = trading_day_offset(end, -start)
+		if not isinstance(start, int) and isinstance(end, int):
+			end = trading_day_offset(start, end)
+		backtest_kwargs = {'start': start, 'end': end, 'log_schedule': log_schedule, 'engine': engine}
+		jobs = [(params, backtest_kwargs) for params in param_grid]
+		results = []
+		def stop(idx, metrics, returns):
+			results.append({**param_grid[idx], **metrics})
+			return should_stop is not None and should_stop(pd.DataFrame(results))
+		self.map_backtests(algo_factory, jobs, processes=processes, callback=stop)
+		return pd.DataFrame(results)
+
+
+	def walk_forward(self, algo_factory, train=252, test=63, step=None, start=datetime.datetime(2018,1,1), end=datetime.datetime.now(), params={}, fit=None, log_schedule=[{"minute": "30", "hour": "13", "day_of_week": "mon-fri"}], engine='schedule', processes=1):
+		# Splits [start, end) into successive windows of train trading days followed by test trading days,
+		# moving forward by step trading days each time (by default step=test, so the test windows do not overlap).
+		# If fit is given, fit(train_start, train_end) is called for each window and returns the params for its test
+		# window (e.g. the best params of a sweep over the train window); otherwise params is used for every window.
+		# The test windows are backtested on the data that is already loaded (in parallel if processes != 1).
+		# Returns a DataFrame with the dates, params and metrics of each window, and the equity curve (starting
+		# at 1) of the test windows stitched together.
+		if step is None:
+			step = test
+		calendar = get_calendar(start, end)
+		first, last = calendar.sessions(start, end)
+		days = calendar.days[first:last].astype('datetime64[us]').tolist()
+		days = [datetime.datetime.combine(day, datetime.time()) for day in days]
+		windows = []
+		for idx in range(train, len(days), step):
+			test_end = days[idx+test] if idx+test < len(days) else end
+			windows.append({'train_start': days[idx-train], 'train_end': days[idx], 'test_start': days[idx], 'test_end': test_end})
+		jobs = []
+		for window in windows:
+			window_params = fit(window['train_start'], window['train_end']) if fit is not None else params
+			window.update(window_params)
+			jobs.append((window_params, {'start': window['test_start'], 'end': window['test_end'], 'log_schedule': log_schedule, 'engine': engine}))
+		returns = [None] * len(windows)
+		def collect(idx, metrics, window_returns):
+			windows[idx].update(metrics)
+			returns[idx] = window_returns
+		self.map_backtests(algo_factory, jobs, processes=processes, callback=collect)
+		returns = [window_returns for window_returns in returns if window_returns is not None]
+		returns = pd.concat(returns).sort_index() if len(returns) > 0 else pd.Series(dtype=np.float64)
+		equity = (1 + returns).cumprod()
+		return pd.DataFrame(windows), equity
+
+
+	def map_backtests(self, algo_factory, jobs, processes=None, callback=None):
+		# Runs a backtest of algo_factory(**params) for each (params, backtest_kwargs) in jobs, and calls
+		# callback(job index, metrics, returns) as each one finishes. If the callback returns True, the
+		# remaining jobs are cancelled. With processes=1 the jobs run in this process on self.data.
+		# Otherwise the data is saved once and memory-mapped by every worker rather than pickled to each of them.
+		if processes == 1:
+			for idx, (params, backtest_kwargs) in enumerate(jobs):
+				metrics, returns = run_backtest(self.data, self.benchmark, algo_factory, params, backtest_kwargs)
+				if callback is not None and callback(idx, metrics, returns):
+					break
+			return
+		directory = tempfile.mkdtemp(prefix="algotrader_data_")
+		try:
+			self.data.save(directory)
+			with ProcessPoolExecutor(max_workers=processes, initializer=init_backtest_worker, initargs=(directory, self.benchmark)) as pool:
+				futures = {pool.submit(run_backtest_worker, algo_factory, params, backtest_kwargs): idx for idx, (params, backtest_kwargs) in enumerate(jobs)}
+				try:
+					for future in as_completed(futures):
+						metrics, returns = future.result()
+						if callback is not None and callback(futures[future], metrics, returns):
+							break
+				except KeyboardInterrupt:
+					pass
+				pool.shutdown(wait=True, cancel_futures=True)
+		finally:
+			shutil.rmtree(directory, ignore_errors=True)
+
+
+	def run_schedule(self, start, end, log_schedule):
+		logging = isinstance(log_schedule, dict) or len(log_schedule) > 0
+		# The fire times of every algo and the logger are expanded up front.
+		# events[i,j] says whether algo j (or the logger, in the last column) runs at times[i]
+		schedules = [algo.schedule for algo in self.algos] + [log_schedule if logging else []]
+		times, events = compile_schedules(schedules, start, end)
+		times = times.astype('datetime64[us]').tolist()
+		for idx in range(len(times)):
+			self.datetime = times[idx]
+			for algo_idx in np.flatnonzero(events[idx,:-1]):
+				self.broker.check_limit_orders(time=self.datetime)
+				self.algos[algo_idx].run_wrapper(time=self.datetime, update=False)
+			if events[idx,-1]:
+				self.log_state()
+
+
 	def run(self, paper=False, log_schedule=[{"minute": "30", "hour": "13", "day_of_week": "mon-fri"}]):
 		self.init_broker(backtest=False, paper=paper)
 		self.datetime = datetime.datetime.utcnow().astimezone(Manager.timezone)
@@ -118,6 +249,8 @@ class Manager:
 		for algo in self.jobs.keys():
 			self.stop_algo(algo)
 		self.scheduler.shutdown(wait=True)
+		if isinstance(self.broker, AlpacaBroker):
+			self.broker.stop()
 
 
 	def pause(self):
@@ -1,48 +1,183 @@
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torch
 import numpy as np
-from AlgoTrader.Util import np_to_datetime
+from numpy.lib.stride_tricks import sliding_window_view
+from AlgoTrader.PriceStore import PriceStore
 
 class MarketDataSet(Dataset):
 
+	# Sliding windows of hist bars over the data of an AlpacaData object. Each datatype is copied once into
+	# a contiguous (symbol, time) tensor, and samples are views into it made by unfold, so a sample never copies
+	# more than its own window. Only times at which every symbol has every datatype are kept.
+	# Timestamps are kept as int64 nanoseconds (see to_datetimes to convert a whole batch at once).
 	def __init__(self, dataobj, hist=1, datatypes=['open']):
-		self.dataobj = dataobj
 		self.hist = hist
 		self.datatypes = datatypes
+		self.symbols = list(dataobj.symbols)
+		times, values = aligned_values(dataobj, datatypes)
+		self.times = torch.from_numpy(times)
+		self.tensors = {datatype: torch.from_numpy(np.ascontiguousarray(values[idx])) for idx, datatype in enumerate(datatypes)}
+		# windows[datatype][s,i] is the view tensors[datatype][s,i:i+hist]
+		self.time_windows = self.times.unfold(0, hist, 1)
+		self.windows = {datatype: tensor.unfold(1, hist, 1) for datatype, tensor in self.tensors.items()}
 
 
 	def __len__(self):
-		return len(self.dataobj.get(self.dataobj.symbols[0])) - self.hist + 1
+		return max(len(self.times) - self.hist + 1, 0)
 
 
 	def __getitem__(self, idx):
-		symbols = self.dataobj.symbols
 		datapoint = {}
-		datapoint['t'] = np_to_datetime(self.dataobj.data[symbols[0]].index.values[idx:idx+self.hist])
-		for symbol in symbols:
-			datapoint[symbol] = {}
-			df = self.dataobj.get(symbol)
-			for datatype in self.datatypes:
-				datapoint[symbol][datatype] = torch.tensor(df[datatype].values)[idx:idx+self.hist]
+		datapoint['t'] = self.time_windows[idx]
+		for s, symbol in enumerate(self.symbols):
+			datapoint[symbol] = {datatype: window[s,idx] for datatype, window in self.windows.items()}
 		return datapoint
 
 
+	def __getitems__(self, indices):
+		# Called by DataLoader with the indices of a whole batch. The batch is gathered with one index
+		# per datatype, and collate_fn passes it through as it is.
+		indices = torch.as_tensor(indices, dtype=torch.int64)
+		batch = {}
+		batch['t'] = self.time_windows[indices]
+		for datatype, window in self.windows.items():
+			values = window[:,indices]
+			for s, symbol in enumerate(self.symbols):
+				batch.setdefault(symbol, {})[datatype] = values[s]
+		return batch
+
+
+
+class MappedMarketDataSet(Dataset):
+
+	# The same samples as MarketDataSet, read from a directory written by export_dataset. The values are
+	# memory-mapped read-only, and only the path is pickled into DataLoader workers, so every worker maps
+	# the same file and shares its pages through the OS page cache instead of holding its own copy.
+	def __init__(self, directory, hist=1):
+		self.directory = directory
+		self.hist = hist
+		self.store = None
+		store = self.open()
+		self.symbols = store.symbols
+		self.datatypes = store.fields
+		self.length = max(len(store.times) - hist + 1, 0)
+
+
+	def open(self):
+		if self.store is None:
+			self.store = PriceStore.load(self.directory, mmap_mode='r')
+			self.time_windows = sliding_window_view(self.store.times, self.hist)
+			self.windows = sliding_window_view(self.store.data, self.hist, axis=2)
+		return self.store
+
+
+	def __getstate__(self):
+		# The mapping is not pickled, each worker opens its own
+		state = self.__dict__.copy()
+		state.pop('time_windows', None)
+		state.pop('windows', None)
+		state['store'] = None
+		return state
+
+
+	def __len__(self):
+		return self.length
+
+
+	def __getitem__(self, idx):
+		self.open()
+		datapoint = {}
+		datapoint['t'] = torch.from_numpy(np.array(self.time_windows[idx]))
+		for s, symbol in enumerate(self.symbols):
+			datapoint[symbol] = {datatype: torch.from_numpy(np.array(self.windows[f,s,idx])) for f, datatype in enumerate(self.datatypes)}
+		return datapoint
+
+
+	def __getitems__(self, indices):
+		# Only the requested windows are copied out of the mapped file, with one index for the whole batch
+		self.open()
+		indices = np.asarray(indices, dtype=np.int64)
+		values = self.windows[:,:,indices]
+		batch = {}
+		batch['t'] = torch.from_numpy(self.time_windows[indices])
+		for s, symbol in enumerate(self.symbols):
+			batch[symbol] = {datatype: torch.from_numpy(values[f,s]) for f, datatype in enumerate(self.datatypes)}
+		return batch
+
+
+
+class WindowBatchSampler(Sampler):
+
+	# Yields batches of window indices as int64 tensors, drawn from indices (all windows by default),
+	# so that DataLoader(dataset, batch_sampler=WindowBatchSampler(...), collate_fn=collate_fn) gathers
+	# each batch with MarketDataSet.__getitems__ instead of one __getitem__ per sample
+	def __init__(self, indices, batch_size=32, shuffle=True, drop_last=False):
+		if isinstance(indices, Dataset):
+			indices = torch.arange(len(indices))
+		self.indices = torch.as_tensor(indices, dtype=torch.int64)
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.drop_last = drop_last
+
+
+	def __iter__(self):
+		indices = self.indices[torch.randperm(len(self.indices))] if self.shuffle else self.indices
+		for start in range(0, len(indices), self.batch_size):
+			batch = indices[start:start+self.batch_size]
+			if self.drop_last and len(batch) < self.batch_size:
+				break
+			yield batch
+
+
+	def __len__(self):
+		if self.drop_last:
+			return len(self.indices) // self.batch_size
+		return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+
+
+def aligned_values(dataobj, datatypes):
+	# Returns the times and the (datatype, symbol, time) values of the data on the time axis of the first
+	# datatype, keeping only times at which every symbol has every datatype. Stores with a different axis
+	# (news is stamped at the end of the day) are matched to it by trading day.
+	times = dataobj.get_store(datatypes[0]).times
+	values = np.full((len(datatypes), len(dataobj.symbols), len(times)), np.nan)
+	target_days = times.view('datetime64[ns]').astype('datetime64[D]')
+	for f, datatype in enumerate(datatypes):
+		store = dataobj.get_store(datatype)
+		series = np.stack([store.series(symbol, datatype) for symbol in dataobj.symbols], axis=0)
+		if np.array_equal(store.times, times):
+			values[f] = series
+		else:
+			days = store.times.view('datetime64[ns]').astype('datetime64[D]')
+			positions = np.minimum(np.searchsorted(days, target_days), len(days) - 1)
+			found = days[positions] == target_days
+			values[f][:,found] = series[:,positions[found]]
+	valid = np.isfinite(values).all(axis=(0,1))
+	return np.ascontiguousarray(times[valid]), np.ascontiguousarray(values[:,:,valid])
+
+
+def export_dataset(dataobj, directory, datatypes=['open']):
+	# Writes the aligned values of an AlpacaData object to directory as a PriceStore (one contiguous .npy
+	# block of shape (datatype, symbol, time) plus the timestamps), to be opened with MappedMarketDataSet
+	times, values = aligned_values(dataobj, datatypes)
+	store = PriceStore(times.view('datetime64[ns]'), dataobj.symbols, datatypes, data=values)
+	store.save(directory)
+	return store
+
+
 def collate_fn(sample_list):
-	datapoints = {'t': []}
-	for sample in sample_list:
-		datapoints['t'].append(sample['t'])
-		for symbol in sample.keys():
-			if symbol != 't':
-				if symbol not in datapoints:
-					datapoints[symbol] = {datatype: [] for datatype in sample[symbol].keys()}
-				for datatype, data in sample[symbol].items():
-					datapoints[symbol][datatype].append(data)
+	# Batches from MarketDataSet.__getitems__ are already collated
+	if isinstance(sample_list, dict):
+		return sample_list
 	tensors = {}
-	tensors['t'] = np.stack(datapoints['t'], axis=0)
-	for symbol in datapoints.keys():
+	tensors['t'] = torch.stack([sample['t'] for sample in sample_list], dim=0)
+	for symbol in sample_list[0].keys():
 		if symbol != 't':
-			if symbol not in tensors:
-				tensors[symbol] = {}
-			for datatype, data in datapoints[symbol].items():
-				tensors[symbol][datatype] = torch.stack(data, dim=0)
-	return tensors
\ No newline at end of file
+			tensors[symbol] = {datatype: torch.stack([sample[symbol][datatype] for sample in sample_list], dim=0) for datatype in sample_list[0][symbol].keys()}
+	return tensors
+
+
+def to_datetimes(t):
+	# int64 nanosecond timestamps (e.g. batch['t']) to datetime64[ns], without a per-element conversion
+	return t.numpy().view('datetime64[ns]')
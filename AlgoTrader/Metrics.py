@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def compute_metrics(returns, benchmark=None, periods=252):
+	# Computes the Logger metrics in one pass over shared intermediates (mean, deviations, compounded growth).
+	# returns is the return series of one run, or a (runs, time) matrix of the returns of several runs on
+	# the same timestamps, which are all scored in one call. benchmark is one return series over the same
+	# timestamps (or a matrix with one row per run). The definitions follow quantstats.
+	# For one run each metric is a float, for a matrix each metric is an array with one value per run.
+	returns = np.asarray(returns, dtype=np.float64)
+	single = returns.ndim == 1
+	returns = np.nan_to_num(np.atleast_2d(returns), nan=0., posinf=0., neginf=0.)
+	count = returns.shape[1]
+	metrics = {}
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean = returns.mean(axis=1)
+		deviations = returns - mean[:,None]
+		std = np.sqrt((deviations ** 2).sum(axis=1) / (count - 1))
+		wins = returns > 0
+		losses = returns < 0
+		downside = np.sqrt((np.where(losses, returns, 0.) ** 2).sum(axis=1) / count)
+		metrics['sharpe'] = mean / std * np.sqrt(periods)
+		metrics['sortino'] = np.where(downside == 0, np.nan, mean / downside * np.sqrt(periods))
+
+		alpha = np.zeros(len(returns))
+		beta = np.zeros(len(returns))
+		if benchmark is not None:
+			benchmark = np.nan_to_num(np.atleast_2d(np.asarray(benchmark, dtype=np.float64)), nan=0., posinf=0., neginf=0.)
+			benchmark_mean = benchmark.mean(axis=1)
+			benchmark_deviations = benchmark - benchmark_mean[:,None]
+			covariance = (deviations * benchmark_deviations).sum(axis=1) / (count - 1)
+			variance = (benchmark_deviations ** 2).sum(axis=1) / (count - 1)
+			beta = np.where(variance == 0, np.nan, covariance / variance)
+			alpha = (mean - beta * benchmark_mean) * periods
+			alpha = np.nan_to_num(alpha, nan=0.)
+			beta = np.nan_to_num(beta, nan=0.)
+		metrics['alpha'] = alpha
+		metrics['beta'] = beta
+
+		# Growth of 1 invested at the start. The drawdown peak starts at 1, so a loss on the first period counts
+		growth = np.cumprod(1 + returns, axis=1)
+		total = growth[:,-1] - 1 if count > 0 else np.zeros(len(returns))
+		peak = np.maximum.accumulate(np.maximum(growth, 1.), axis=1)
+		metrics['cagr'] = np.where(total + 1 < 0, np.nan, np.abs(total + 1) ** (periods / count) - 1)
+		metrics['max drawdown'] = np.minimum((growth / peak).min(axis=1, initial=1.) - 1, 0.)
+
+		win_count = wins.sum(axis=1)
+		loss_count = losses.sum(axis=1)
+		metrics['avg win'] = np.where(wins, returns, 0.).sum(axis=1) / win_count
+		metrics['avg loss'] = np.where(losses, returns, 0.).sum(axis=1) / loss_count
+		metrics['win rate'] = np.where(win_count + loss_count == 0, 0., win_count / (win_count + loss_count))
+		metrics['total return'] = total
+	if single:
+		metrics = {metric: float(value[0]) for metric, value in metrics.items()}
+	return metrics
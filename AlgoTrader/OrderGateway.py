@@ -0,0 +1,162 @@
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+
+class OrderTicket:
+
+	# Handle of an order sent through an OrderGateway. submitted resolves to the order returned by the API once it
+	# has been accepted (or to the exception that rejected it), and done resolves to the final trade update event
+	# ('fill', 'canceled', 'expired', 'rejected', ...) when the trade update stream reports it. fills lists the
+	# (qty, price) of each fill so far.
+	def __init__(self, client_order_id, params, callback=None):
+		self.client_order_id = client_order_id
+		self.params = params
+		self.callback = callback
+		self.order = None
+		self.fills = []
+		self.submitted = Future()
+		self.done = Future()
+
+
+	def on_done(self, callback):
+		# callback(ticket, event) is called once the order is done
+		self.done.add_done_callback(lambda future: callback(self, future.result()))
+
+
+
+class OrderGateway:
+
+	# Sends orders and cancellations to the trading API concurrently from a thread pool (the REST client keeps its
+	# HTTP connections open, so the requests share them). At most max_in_flight orders are waiting for the API at
+	# once; submit blocks until a slot is free. Every order carries a client order ID, which makes sending it
+	# idempotent: submitting the same ID again returns the same ticket, and a request that fails after the order
+	# may have reached the broker is checked against the ID before it is reported as failed.
+	# Tickets are kept until the trade update stream reports them done; with track=False (no stream)
+	# they are dropped once the API has accepted them.
+	final_events = ('fill', 'canceled', 'expired', 'rejected', 'replaced', 'done_for_day')
+	# Order statuses of the API that mean the order is done, and the trade update event each one corresponds to
+	final_statuses = {'filled': 'fill', 'canceled': 'canceled', 'expired': 'expired', 'rejected': 'rejected', 'replaced': 'replaced', 'done_for_day': 'done_for_day'}
+
+	def __init__(self, api, max_workers=8, max_in_flight=32, track=True):
+		self.api = api
+		self.track = track
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+		self.slots = threading.BoundedSemaphore(max_in_flight)
+		self.tickets = {}
+		self.lock = threading.Lock()
+
+
+	def submit(self, client_order_id=None, callback=None, **params):
+		# params are the arguments of api.submit_order. Returns an OrderTicket without waiting for the API.
+		# callback(ticket, error) is called when the API has answered, before ticket.submitted resolves.
+		if client_order_id is None:
+			client_order_id = uuid.uuid4().hex
+		with self.lock:
+			if client_order_id in self.tickets:
+				return self.tickets[client_order_id]
+			ticket = OrderTicket(client_order_id, params, callback)
+			self.tickets[client_order_id] = ticket
+		self.slots.acquire()
+		self.executor.submit(self.send, ticket)
+		return ticket
+
+
+	def send(self, ticket):
+		try:
+			try:
+				order = self.api.submit_order(client_order_id=ticket.client_order_id, **ticket.params)
+			except Exception as error:
+				order = self.find(ticket.client_order_id)
+				if order is None:
+					raise error
+			ticket.order = order
+			if not self.track:
+				self.forget(ticket.client_order_id)
+			if ticket.callback is not None:
+				ticket.callback(ticket, None)
+			ticket.submitted.set_result(order)
+		except Exception as error:
+			self.forget(ticket.client_order_id)
+			if ticket.callback is not None:
+				ticket.callback(ticket, error)
+			ticket.submitted.set_exception(error)
+			ticket.done.set_result('rejected')
+		finally:
+			self.slots.release()
+
+
+	def find(self, client_order_id):
+		# The order with this client order ID if the broker has it, None otherwise
+		try:
+			return self.api.get_order_by_client_order_id(client_order_id)
+		except Exception:
+			return None
+
+
+	def cancel(self, order_ids):
+		# Cancels every order in order_ids at once. Returns one future per order.
+		return [self.executor.submit(self.api.cancel_order, order_id) for order_id in order_ids]
+
+
+	def cancel_all(self, symbol=None):
+		# Cancels all open orders (of one symbol if it is given), and waits for the cancellations to go through
+		if symbol is None:
+			self.api.cancel_all_orders()
+			return
+		orders = self.api.list_orders(status='open', symbols=[symbol])
+		futures = self.cancel([order.id for order in orders if order.symbol == symbol])
+		for future in futures:
+			future.result()
+
+
+	def on_trade_update(self, event, client_order_id, order, qty=None, price=None):
+		with self.lock:
+			ticket = self.tickets.get(client_order_id)
+		if ticket is None:
+			return
+		ticket.order = order
+		if event in ('fill', 'partial_fill') and qty is not None and price is not None:
+			ticket.fills.append((float(qty), float(price)))
+		if event in OrderGateway.final_events and not ticket.done.done():
+			self.forget(client_order_id)
+			ticket.done.set_result(event)
+
+
+	def forget(self, client_order_id):
+		with self.lock:
+			self.tickets.pop(client_order_id, None)
+
+
+	def wait(self, tickets, timeout=None):
+		# Waits until every ticket has been accepted or rejected by the API, and returns their orders
+		wait([ticket.submitted for ticket in tickets], timeout=timeout)
+		return [ticket.submitted.result(timeout=0) for ticket in tickets]
+
+
+	def wait_done(self, tickets, timeout=None, poll=1.):
+		# Waits until every ticket is done (filled, canceled, ...) or timeout seconds have passed, and returns the
+		# tickets that are not done. Without the trade update stream (track=False) the orders are polled every poll seconds.
+		start = time.monotonic()
+		wait([ticket.submitted for ticket in tickets], timeout=timeout)
+		if self.track:
+			remaining = None if timeout is None else max(timeout - (time.monotonic() - start), 0)
+			wait([ticket.done for ticket in tickets], timeout=remaining)
+		else:
+			while True:
+				for ticket in tickets:
+					if ticket.done.done():
+						continue
+					order = self.find(ticket.client_order_id)
+					if order is not None and order.status in OrderGateway.final_statuses:
+						ticket.order = order
+						ticket.done.set_result(OrderGateway.final_statuses[order.status])
+				if all(ticket.done.done() for ticket in tickets) or (timeout is not None and time.monotonic() - start >= timeout):
+					break
+				time.sleep(poll)
+		return [ticket for ticket in tickets if not ticket.done.done()]
+
+
+	def shutdown(self):
+		self.executor.shutdown(wait=True)
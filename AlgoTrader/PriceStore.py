@@ -0,0 +1,156 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from AlgoTrader.Util import TimeIndex
+
+
+class PriceStore:
+
+	# Columnar store for bar data. All symbols share one timestamp axis, and the values live in one
+	# contiguous float64 block of shape (field, symbol, time). data[f,s,:] is a contiguous time series
+	# and data[f,:,t] is a strided cross section, so both kinds of read are views.
+	# Symbols that have no bar at a timestamp on the shared axis hold NaN there.
+	def __init__(self, times, symbols, fields, data=None):
+		self.index = TimeIndex(times)
+		self.times = self.index.times
+		self.symbols = list(symbols)
+		self.fields = list(fields)
+		self.symbol_idx = {symbol: idx for idx, symbol in enumerate(self.symbols)}
+		self.field_idx = {field: idx for idx, field in enumerate(self.fields)}
+		if data is None:
+			data = np.full((len(self.fields), len(self.symbols), len(self.times)), np.nan)
+		self.data = data
+		self.size = len(self.times)
+		# Bars appended live go into spare capacity at the end of these buffers, and times/data are views of
+		# the filled part. The buffers are only copied when they are full, with the capacity doubled each time.
+		self.time_buffer = self.times
+		self.buffer = data
+		self.cached_datetimes = None
+		# valid_buffer[s,t] is the position of the last bar up to t at which symbol s has a close (-1 if there is
+		# none). It is filled in up to valid_size on the first quote that needs it, and extended as bars are appended.
+		self.valid_buffer = None
+		self.valid_size = 0
+
+
+	@property
+	def datetimes(self):
+		if self.cached_datetimes is None or len(self.cached_datetimes) != self.size:
+			self.cached_datetimes = pd.DatetimeIndex(self.times.view('datetime64[ns]')).tz_localize('UTC')
+		return self.cached_datetimes
+
+
+	@staticmethod
+	def from_frames(frames, fields=None):
+		# frames: {symbol: DataFrame indexed by timestamp with one column per field}
+		symbols = list(frames.keys())
+		if fields is None:
+			fields = []
+			for frame in frames.values():
+				fields += [field for field in frame.columns if field not in fields]
+		indices = {symbol: TimeIndex(frame.index).times for symbol, frame in frames.items()}
+		times = np.unique(np.concatenate(list(indices.values()))) if len(indices) > 0 else np.array([], dtype=np.int64)
+		store = PriceStore(times.view('datetime64[ns]'), symbols, fields)
+		for symbol, frame in frames.items():
+			positions = np.searchsorted(store.times, indices[symbol])
+			s = store.symbol_idx[symbol]
+			for field in frame.columns:
+				if field in store.field_idx:
+					store.data[store.field_idx[field], s, positions] = frame[field].to_numpy(dtype=np.float64)
+		return store
+
+
+	def save(self, directory):
+		os.makedirs(directory, exist_ok=True)
+		np.save(os.path.join(directory, "data.npy"), self.data)
+		np.save(os.path.join(directory, "times.npy"), self.times)
+		with open(os.path.join(directory, "meta.json"), 'w') as f:
+			json.dump({'symbols': self.symbols, 'fields': self.fields}, f)
+
+
+	@staticmethod
+	def load(directory, mmap_mode='r'):
+		# With mmap_mode='r' the values are memory-mapped read-only, so processes that load the same
+		# store share its pages through the OS page cache instead of each holding a copy
+		with open(os.path.join(directory, "meta.json")) as f:
+			meta = json.load(f)
+		data = np.load(os.path.join(directory, "data.npy"), mmap_mode=mmap_mode)
+		times = np.load(os.path.join(directory, "times.npy"))
+		return PriceStore(times.view('datetime64[ns]'), meta['symbols'], meta['fields'], data=data)
+
+
+	def __len__(self):
+		return self.size
+
+
+	def column(self, time):
+		# Position of the bar at time (int64 ns) on the time axis. A time after the last bar appends a new
+		# bar (NaN for every symbol). Returns None for an earlier time that is not on the axis.
+		if self.size > 0 and time <= self.times[-1]:
+			idx = int(np.searchsorted(self.times, time))
+			return idx if self.times[idx] == time else None
+		if self.size == len(self.time_buffer):
+			capacity = max(2 * self.size, 16)
+			time_buffer = np.empty(capacity, dtype=np.int64)
+			time_buffer[:self.size] = self.times
+			buffer = np.full((len(self.fields), len(self.symbols), capacity), np.nan)
+			buffer[:,:,:self.size] = self.data
+			self.time_buffer, self.buffer = time_buffer, buffer
+		# data is published before times, so a reader that indexes data by a position on times
+		# (possibly from another thread) never goes past the end of data
+		self.time_buffer[self.size] = time
+		self.data = self.buffer[:,:,:self.size+1]
+		self.times = self.time_buffer[:self.size+1]
+		self.index.times = self.times
+		self.size += 1
+		return self.size - 1
+
+
+	def series(self, symbol, field):
+		return self.data[self.field_idx[field], self.symbol_idx[symbol], :]
+
+
+	def cross_section(self, field, idx):
+		return self.data[self.field_idx[field], :, idx]
+
+
+	def quote_section(self, field, idx):
+		# Cross section of field at idx for pricing. Symbols without a bar there (halted, or not trading at that
+		# time) are priced at their last close before it, and stay NaN if they have none.
+		values = self.cross_section(field, idx)
+		missing = np.flatnonzero(np.isnan(values))
+		if len(missing) == 0:
+			return values
+		values = values.copy()
+		positions = self.last_valid(idx)[missing]
+		found = positions >= 0
+		values[missing[found]] = self.data[self.field_idx['close'], missing[found], positions[found]]
+		return values
+
+
+	def last_valid(self, idx):
+		# Position of the last bar up to idx at which each symbol has a close (-1 if it has none)
+		if self.valid_size <= idx:
+			start = self.valid_size
+			if self.valid_buffer is None or self.valid_buffer.shape[1] < self.size:
+				valid_buffer = np.empty((len(self.symbols), len(self.time_buffer)), dtype=np.int32)
+				if self.valid_buffer is not None:
+					valid_buffer[:,:start] = self.valid_buffer[:,:start]
+				self.valid_buffer = valid_buffer
+			closes = self.data[self.field_idx['close'], :, start:self.size]
+			positions = np.where(np.isnan(closes), -1, np.arange(start, self.size, dtype=np.int32))
+			if start > 0:
+				positions[:,0] = np.maximum(positions[:,0], self.valid_buffer[:,start-1])
+			np.maximum.accumulate(positions, axis=1, out=self.valid_buffer[:,start:self.size])
+			self.valid_size = self.size
+		return self.valid_buffer[:,idx]
+
+
+	def invalidate(self, idx):
+		# Called after bars from idx onwards were written in place, so that last_valid looks at them again
+		self.valid_size = min(self.valid_size, idx)
+
+
+	def frame(self, symbol):
+		s = self.symbol_idx[symbol]
+		return pd.DataFrame(self.data[:,s,:].T, index=self.datetimes, columns=self.fields)
@@ -0,0 +1,159 @@
+import datetime
+import numpy as np
+import pandas as pd
+from apscheduler.triggers.cron import CronTrigger
+from AlgoTrader.Util import get_calendar, next_runtime, to_datetime64
+
+
+FIELD_NAMES = ('year', 'month', 'day', 'week', 'day_of_week', 'hour', 'minute', 'second')
+DEFAULT_VALUES = {'year': '*', 'month': 1, 'day': 1, 'week': '*', 'day_of_week': '*', 'hour': 0, 'minute': 0, 'second': 0}
+FIELD_RANGES = {'year': (1970, 9999), 'month': (1, 12), 'day': (1, 31), 'week': (1, 53), 'day_of_week': (0, 6), 'hour': (0, 23), 'minute': (0, 59), 'second': (0, 59)}
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+
+def compile_schedule(schedule, start, end):
+	# Expands a cron schedule (the input to build_trigger) into a sorted datetime64[ns] array
+	# of every fire time on a trading day in [start, end)
+	if isinstance(schedule, dict):
+		schedule = [schedule]
+	start = to_datetime64(start)
+	end = to_datetime64(end)
+	times = [compile_cron(cron, start, end) for cron in schedule]
+	if len(times) == 0:
+		return np.array([], dtype='datetime64[ns]')
+	return np.unique(np.concatenate(times))
+
+
+def schedule_stream(schedule, start, end, window=np.timedelta64(30, 'D')):
+	# Yields the fire times of compile_schedule(schedule, start, end) in order, compiling them one window
+	# at a time so that only one window of fire times is held in memory
+	start = to_datetime64(start)
+	end = to_datetime64(end)
+	get_calendar(start, end)
+	while start < end:
+		window_end = min(start + window, end)
+		yield from compile_schedule(schedule, start, window_end)
+		start = window_end
+
+
+def compile_schedules(schedules, start, end):
+	# Merges several schedules into one timeline.
+	# Returns the sorted fire times, and a bool table where events[i,j] is True if schedule j fires at times[i]
+	compiled = [compile_schedule(schedule, start, end) for schedule in schedules]
+	if len(compiled) == 0:
+		return np.array([], dtype='datetime64[ns]'), np.zeros((0, 0), dtype=bool)
+	times = np.unique(np.concatenate(compiled))
+	events = np.zeros((len(times), len(compiled)), dtype=bool)
+	for idx, fire_times in enumerate(compiled):
+		events[np.searchsorted(times, fire_times), idx] = True
+	return times, events
+
+
+def compile_cron(cron, start, end):
+	fields = resolve_fields(cron)
+	if fields is None:
+		return step_cron(cron, start, end)
+	calendar = get_calendar(start, end)
+	first, last = calendar.sessions(start, end)
+	days = calendar.days[first:last]
+	mask = np.ones(len(days), dtype=bool)
+	if fields['year'] is not None:
+		mask &= np.isin(days.astype('datetime64[Y]').astype(np.int64) + 1970, fields['year'])
+	if fields['month'] is not None:
+		mask &= np.isin(days.astype('datetime64[M]').astype(np.int64) % 12 + 1, fields['month'])
+	if fields['day'] is not None:
+		mask &= np.isin((days - days.astype('datetime64[M]')).astype(np.int64) + 1, fields['day'])
+	if fields['week'] is not None:
+		mask &= np.isin(pd.DatetimeIndex(days).isocalendar().week.values.astype(np.int64), fields['week'])
+	if fields['day_of_week'] is not None:
+		# 1970-01-01 was a thursday, and apscheduler counts monday as 0
+		mask &= np.isin((days.astype(np.int64) + 3) % 7, fields['day_of_week'])
+	days = days[mask].astype('datetime64[ns]')
+	hours = all_values('hour', fields['hour'])
+	minutes = all_values('minute', fields['minute'])
+	seconds = all_values('second', fields['second'])
+	offsets = (hours[:,None,None] * 3600 + minutes[None,:,None] * 60 + seconds[None,None,:]).ravel()
+	offsets = np.sort(offsets).astype('timedelta64[s]').astype('timedelta64[ns]')
+	times = (days[:,None] + offsets[None,:]).ravel()
+	return times[(times >= start) & (times < end)]
+
+
+def step_cron(cron, start, end):
+	# Fallback for cron expressions that the vectorized compiler does not understand.
+	# Steps through the fire times with apscheduler, which is slow but exact.
+	trigger = CronTrigger(**cron)
+	end = end.astype('datetime64[us]').astype(datetime.datetime)
+	time = start.astype('datetime64[us]').astype(datetime.datetime) - datetime.timedelta(seconds=1)
+	times = []
+	while True:
+		time = next_runtime(trigger, time)
+		if time >= end:
+			break
+		times.append(time)
+	return np.array(times, dtype='datetime64[ns]')
+
+
+def resolve_fields(cron):
+	# Mirrors the way CronTrigger fills in missing fields: fields that are more significant than
+	# the least significant given field are '*', and the rest take their default (minimum) value.
+	# Returns None if the cron uses an option that the vectorized compiler does not support.
+	values = dict(cron)
+	if any(key not in FIELD_NAMES for key in values.keys()):
+		return None
+	fields = {}
+	assign_defaults = False
+	for field in FIELD_NAMES:
+		if field in values:
+			expr = values.pop(field)
+			assign_defaults = len(values) == 0
+		elif assign_defaults:
+			expr = DEFAULT_VALUES[field]
+		else:
+			expr = '*'
+		try:
+			fields[field] = parse_field(field, expr)
+		except ValueError:
+			return None
+	return fields
+
+
+def parse_field(field, expr):
+	# Returns a sorted array of the allowed values, or None if every value is allowed
+	lo, hi = FIELD_RANGES[field]
+	values = set()
+	for part in str(expr).lower().replace(' ', '').split(','):
+		if '/' in part:
+			part, step = part.split('/')
+			step = int(step)
+		else:
+			step = None
+		if part == '*':
+			if step is None:
+				return None
+			first, last = lo, hi
+		elif '-' in part:
+			first, last = part.split('-')
+			first, last = parse_value(field, first), parse_value(field, last)
+		else:
+			first = parse_value(field, part)
+			last = hi if step is not None else first
+		if first < lo or last > hi or first > last:
+			raise ValueError("cron value {expr} is out of range for {field}.".format(expr=expr, field=field))
+		values.update(range(first, last + 1, step or 1))
+	return np.array(sorted(values), dtype=np.int64)
+
+
+def parse_value(field, value):
+	if field == 'day_of_week' and value in DAY_NAMES:
+		return DAY_NAMES.index(value)
+	if field == 'month' and value in MONTH_NAMES:
+		return MONTH_NAMES.index(value) + 1
+	return int(value)
+
+
+def all_values(field, values):
+	if values is None:
+		lo, hi = FIELD_RANGES[field]
+		return np.arange(lo, hi + 1, dtype=np.int64)
+	return values
@@ -0,0 +1,98 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+
+_pipelines = {}
+_pipelines_lock = threading.Lock()
+
+def get_pipeline(model):
+	# The model is loaded once per process and shared by every SentimentModel that uses it
+	with _pipelines_lock:
+		if model not in _pipelines:
+			from transformers import pipeline
+			_pipelines[model] = pipeline("sentiment-analysis", model=model)
+		return _pipelines[model]
+
+
+class SentimentModel:
+
+	# Scores article summaries in batches, and memoizes the scores in a local sqlite file so that
+	# an article is only ever scored once per model. A custom scorer (a function that maps a list of
+	# strings to a list of {'label', 'score'} dicts, like a HuggingFace pipeline) can replace the model.
+	# Its scores are only written to the file under scorer_name if one is given (so that they are never
+	# served as the model's), otherwise they are memoized in memory. The file is opened on first use.
+	def __init__(self, model="ahmedrachid/FinancialBERT-Sentiment-Analysis", batch_size=32, cache_dir="~/.algotrader/sentiment", scorer=None, scorer_name=None):
+		# mrm8488/distilroberta-finetuned-financial-news-sentiment-analysis
+		# ahmedrachid/FinancialBERT-Sentiment-Analysis
+		self.model = model
+		self.batch_size = batch_size
+		self.scorer = scorer
+		self.name = model if scorer is None else scorer_name
+		self.cache_dir = cache_dir if self.name is not None else None
+		self.db = None
+		self.memory = {}
+		self.lock = threading.Lock()
+
+
+	def connect(self):
+		with self.lock:
+			if self.db is None and self.cache_dir is not None:
+				cache_dir = os.path.expanduser(self.cache_dir)
+				os.makedirs(cache_dir, exist_ok=True)
+				self.db = sqlite3.connect(os.path.join(cache_dir, "scores.db"), check_same_thread=False)
+				self.db.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL)")
+			return self.db
+
+
+	def score(self, texts, ids=None):
+		# Returns the signed score of each text: +confidence if positive, -confidence if negative, 0 if neutral
+		keys = [self.key(text, None if ids is None else ids[idx]) for idx, text in enumerate(texts)]
+		scores = self.lookup(keys)
+		missing = [idx for idx, key in enumerate(keys) if key not in scores]
+		if len(missing) > 0:
+			results = []
+			scorer = self.scorer if self.scorer is not None else get_pipeline(self.model)
+			for start in range(0, len(missing), self.batch_size):
+				batch = [texts[idx] for idx in missing[start:start+self.batch_size]]
+				results += scorer(batch, truncation=True, batch_size=self.batch_size) if self.scorer is None else scorer(batch)
+			for idx, result in zip(missing, results):
+				classification = 0
+				if result['label'] == "positive":
+					classification = 1
+				elif result['label'] == "negative":
+					classification = -1
+				scores[keys[idx]] = classification * result['score']
+			self.save({keys[idx]: scores[keys[idx]] for idx in missing})
+		return np.array([scores[key] for key in keys], dtype=np.float64)
+
+
+	def key(self, text, id=None):
+		if id is not None:
+			return "{model}:id:{id}".format(model=self.name, id=id)
+		return "{model}:sha1:{hash}".format(model=self.name, hash=hashlib.sha1(text.encode()).hexdigest())
+
+
+	def lookup(self, keys):
+		if len(keys) == 0:
+			return {}
+		db = self.connect()
+		if db is None:
+			return {key: self.memory[key] for key in keys if key in self.memory}
+		scores = {}
+		for start in range(0, len(keys), 500):
+			batch = keys[start:start+500]
+			query = "SELECT key, score FROM scores WHERE key IN ({params})".format(params=",".join("?" * len(batch)))
+			scores.update(dict(db.execute(query, batch).fetchall()))
+		return scores
+
+
+	def save(self, scores):
+		db = self.connect()
+		if db is None:
+			self.memory.update(scores)
+			return
+		with db:
+			db.executemany("INSERT OR REPLACE INTO scores (key, score) VALUES (?, ?)", list(scores.items()))
@@ -0,0 +1,87 @@
+import re
+import numpy as np
+from AlgoTrader.PriceStore import PriceStore
+from AlgoTrader.Util import get_calendar, ns_to_datetime
+
+MINUTE_NS = 60 * 10**9
+DAY_NS = 24 * 3600 * 10**9
+# Daily bars are stamped at 20:00 UTC of their day
+BAR_NS = 20 * 3600 * 10**9
+
+
+def parse_timeframe(timeframe):
+	# 'minute', 'hour', 'day' or 'Nmin' (e.g. '5min') to the bar width in minutes (None for days)
+	if timeframe == 'day':
+		return None
+	if timeframe == 'minute':
+		return 1
+	if timeframe == 'hour':
+		return 60
+	match = re.fullmatch(r"(\d+)min", timeframe)
+	if match is None:
+		raise ValueError(f"timeframe {timeframe} not recognised.")
+	return int(match.group(1))
+
+
+def session_bins(times, timeframe):
+	# Assigns each time (int64 ns) to a bar of the timeframe. Bars are aligned to the open of each NYSE session,
+	# times outside of a session belong to no bar. Returns the positions of the times inside a session,
+	# and the timestamp of the bar of each of them: the start of the bar, or 20:00 of the day for daily bars.
+	width = parse_timeframe(timeframe)
+	if len(times) == 0:
+		return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+	calendar = get_calendar(ns_to_datetime(times[0]), ns_to_datetime(times[-1]))
+	opens = calendar.opens.view(np.int64)
+	closes = calendar.closes.view(np.int64)
+	session = np.searchsorted(opens, times, side='right') - 1
+	inside = (session >= 0) & (times < closes[np.maximum(session, 0)])
+	positions = np.flatnonzero(inside)
+	session = session[positions]
+	if width is None:
+		bar_times = calendar.days[session].astype('datetime64[ns]').view(np.int64) + BAR_NS
+	else:
+		offset = times[positions] - opens[session]
+		bar_times = opens[session] + offset - offset % (width * MINUTE_NS)
+	return positions, bar_times
+
+
+def aggregate(store, timeframe, lo=0):
+	# Aggregates the bars of store from position lo onwards into bars of a coarser timeframe, for every symbol at
+	# once: each bar is a contiguous run of source bars, so every field is one reduceat over the time axis.
+	# Returns the aggregated PriceStore, and the source position at which each of its bars starts.
+	positions, bar_times = session_bins(store.times[lo:], timeframe)
+	if len(positions) == 0:
+		return PriceStore(np.array([], dtype='datetime64[ns]'), store.symbols, store.fields), np.array([], dtype=np.int64)
+	starts = np.concatenate([[0], np.flatnonzero(np.diff(bar_times)) + 1])
+	values = store.data[:,:,lo:][:,:,positions]
+	f = store.field_idx
+	close = values[f['close']]
+	valid = ~np.isnan(close)
+	index = np.arange(len(positions))
+	first = np.minimum.reduceat(np.where(valid, index, len(positions)), starts, axis=-1)
+	last = np.maximum.reduceat(np.where(valid, index, -1), starts, axis=-1)
+	empty = last < 0
+	first = np.minimum(first, len(positions) - 1)
+	last = np.maximum(last, 0)
+	volume = np.add.reduceat(np.nan_to_num(values[f['volume']]), starts, axis=-1) if 'volume' in f else None
+	data = np.empty((len(store.fields), len(store.symbols), len(starts)))
+	for field, idx in f.items():
+		if field == 'open':
+			result = np.take_along_axis(values[idx], first, axis=-1)
+		elif field == 'high':
+			result = np.fmax.reduceat(values[idx], starts, axis=-1)
+		elif field == 'low':
+			result = np.fmin.reduceat(values[idx], starts, axis=-1)
+		elif field == 'volume':
+			result = volume
+		elif field == 'trade_count':
+			result = np.add.reduceat(np.nan_to_num(values[idx]), starts, axis=-1)
+		elif field == 'vwap' and volume is not None:
+			traded = np.add.reduceat(np.nan_to_num(values[idx] * values[f['volume']]), starts, axis=-1)
+			with np.errstate(divide='ignore', invalid='ignore'):
+				result = np.where(volume > 0, traded / volume, np.take_along_axis(values[f['close']], last, axis=-1))
+		else:
+			result = np.take_along_axis(values[idx], last, axis=-1)
+		data[idx] = np.where(empty, np.nan, result)
+	aggregated = PriceStore(bar_times[starts].view('datetime64[ns]'), store.symbols, store.fields, data=data)
+	return aggregated, positions[starts] + lo
@@ -0,0 +1,110 @@
+from alpaca.data.requests import CryptoBarsRequest, StockBarsRequest
+from alpaca.data.live import CryptoDataStream, StockDataStream
+from alpaca.data.timeframe import TimeFrame
+import alpaca_trade_api as tradeapi
+import pandas as pd
+import asyncio
+import types
+import time
+from AlgoTrader.Clients import get_registry
+
+
+class AlpacaTransport:
+
+	# The network layer of AlpacaData. Its REST clients come from the process-wide ClientRegistry, so their HTTP
+	# sessions stay open, they are shared with every other AlpacaData and the broker, and their requests go through
+	# the shared rate limiter. Any object with the same get_bars/get_news methods can be passed to AlpacaData
+	# instead, e.g. a stub that serves fixtures from disk.
+	# stream_url replaces the address of the bar websocket, e.g. with a local server that replays recorded bars.
+	max_batch_size = 100
+
+	def __init__(self, api_key, secret_key, stream_url=None):
+		self.api_key = api_key
+		self.secret_key = secret_key
+		self.stream_url = stream_url
+
+
+	def get_client(self, is_crypto):
+		return get_registry().data_client(is_crypto, self.api_key, self.secret_key)
+
+
+	def get_news_client(self):
+		return get_registry().news_client(self.api_key, self.secret_key)
+
+
+	def get_bars(self, symbols, start, end, is_crypto=False, timeframe='day'):
+		# One request for up to max_batch_size symbols of 'day' or 'minute' bars. Returns a DataFrame indexed by (symbol, timestamp)
+		client = self.get_client(is_crypto)
+		timeframe = TimeFrame.Day if timeframe == 'day' else TimeFrame.Minute
+		if is_crypto:
+			request_params = CryptoBarsRequest(
+			                        symbol_or_symbols=symbols,
+			                        timeframe=timeframe,
+			                        start=start,
+			                        end=end,
+			                 )
+			return client.get_crypto_bars(request_params).df
+		else:
+			request_params = StockBarsRequest(
+			                        symbol_or_symbols=symbols,
+			                        timeframe=timeframe,
+			                        start=start,
+			                        end=end,
+			                 )
+			return client.get_stock_bars(request_params).df
+
+
+	def get_news(self, symbol, start, end):
+		# Returns a DataFrame with the headline and summary of each article, indexed by creation time
+		news = self.get_news_client().get_news(symbol=symbol, start=start.strftime("%Y-%m-%d"), end=end.strftime("%Y-%m-%d"), sort=tradeapi.rest.Sort.Asc, limit=100000)
+		news_bars = pd.DataFrame({
+			"id": [article.id for article in news],
+			"headline": [article.headline for article in news],
+			"summary": [article.summary for article in news],
+		}, index=pd.Index([article.created_at for article in news], name='timestamp'))
+		return news_bars
+
+
+	def get_stream(self, is_crypto=False):
+		# A new websocket stream of minute bars. Streams have subscribe_bars(handler, *symbols), a blocking run() and stop()
+		if is_crypto:
+			return CryptoDataStream(self.api_key, self.secret_key, url_override=self.stream_url)
+		return StockDataStream(self.api_key, self.secret_key, url_override=self.stream_url)
+
+
+
+class ReplayStream:
+
+	# Stands in for a websocket bar stream by replaying bars from a DataFrame indexed by (symbol, timestamp),
+	# in the format of AlpacaTransport.get_bars. delay is the pause between bars in seconds.
+	def __init__(self, bars, delay=0.):
+		self.bars = bars.sort_index(level="timestamp")
+		self.delay = delay
+		self.handlers = []
+		self.running = False
+
+
+	def subscribe_bars(self, handler, *symbols):
+		self.handlers.append((handler, set(symbols)))
+
+
+	def run(self):
+		self.running = True
+		loop = asyncio.new_event_loop()
+		try:
+			for (symbol, timestamp), row in zip(self.bars.index, self.bars.to_dict('records')):
+				if not self.running:
+					break
+				bar = types.SimpleNamespace(symbol=symbol, timestamp=timestamp, **row)
+				for handler, symbols in self.handlers:
+					if symbol in symbols:
+						loop.run_until_complete(handler(bar))
+				if self.delay > 0:
+					time.sleep(self.delay)
+		finally:
+			loop.close()
+			self.running = False
+
+
+	def stop(self):
+		self.running = False
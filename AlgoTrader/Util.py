@@ -1,5 +1,3 @@
-import pandas_market_calendars as mcal
-import alpaca_trade_api as tradeapi
 import datetime
 import json
 import pandas as pd
@@ -8,33 +6,148 @@ from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.combining import OrTrigger
 import copy
 
-nyse = mcal.get_calendar('NYSE')
+class TradingCalendar:
+
+	# Session dates and open/close times are held as sorted datetime64 arrays so that
+	# every query is a binary search instead of a call to nyse.schedule
+	def __init__(self, start=datetime.datetime(1990,1,1), end=None, name='NYSE'):
+		if end is None:
+			end = datetime.datetime.now() + datetime.timedelta(days=5*365)
+		self.name = name
+		self.start = to_datetime64(start, unit='D')
+		self.end = to_datetime64(end, unit='D')
+		import pandas_market_calendars as mcal
+		schedule = mcal.get_calendar(name).schedule(start_date=str(self.start), end_date=str(self.end))
+		self.days = schedule.index.values.astype('datetime64[D]')
+		self.opens = schedule['market_open'].dt.tz_convert(None).values.astype('datetime64[ns]')
+		self.closes = schedule['market_close'].dt.tz_convert(None).values.astype('datetime64[ns]')
+
+
+	def covers(self, start, end=None):
+		if end is None:
+			end = start
+		return self.start <= to_datetime64(start, unit='D') and to_datetime64(end, unit='D') <= self.end
+
+
+	def is_trading_day(self, date):
+		day = to_datetime64(date, unit='D')
+		idx = np.searchsorted(self.days, day, side='left')
+		return idx < len(self.days) and self.days[idx] == day
+
+
+	def offset(self, day, offset):
+		# offset < 0: the session that is |offset| sessions before the last session <= day
+		# offset >= 0: the session that is offset sessions after the first session >= day
+		day = to_datetime64(day, unit='D')
+		if offset < 0:
+			idx = np.searchsorted(self.days, day, side='right') - 1 + offset
+		else:
+			idx = np.searchsorted(self.days, day, side='left') + offset
+		if idx < 0 or idx >= len(self.days):
+			raise IndexError("trading day offset {offset} from {day} is outside the calendar.".format(offset=offset, day=day))
+		return self.days[idx].astype('datetime64[us]').astype(datetime.datetime)
+
+
+	def next_trading_day(self, date):
+		# first session on or after date
+		idx = np.searchsorted(self.days, to_datetime64(date, unit='D'), side='left')
+		if idx >= len(self.days):
+			raise IndexError("{date} is outside the calendar.".format(date=date))
+		return self.days[idx].astype('datetime64[us]').astype(datetime.datetime)
+
+
+	def sessions(self, start, end):
+		# indices [first, last) of the sessions whose dates lie in [start, end]
+		first = np.searchsorted(self.days, to_datetime64(start, unit='D'), side='left')
+		last = np.searchsorted(self.days, to_datetime64(end, unit='D'), side='right')
+		return first, last
+
+
+_calendar = None
+
+def get_calendar(start=None, end=None):
+	global _calendar
+	if _calendar is None:
+		_calendar = TradingCalendar()
+	if start is not None and not _calendar.covers(start, end):
+		lo = min(_calendar.start, to_datetime64(start, unit='D') - np.timedelta64(30, 'D'))
+		hi = max(_calendar.end, to_datetime64(end if end is not None else start, unit='D') + np.timedelta64(30, 'D'))
+		_calendar = TradingCalendar(start=lo.astype(datetime.datetime), end=hi.astype(datetime.datetime))
+	return _calendar
+
+
+def to_datetime64(time, unit='ns'):
+	if isinstance(time, np.datetime64):
+		return time.astype('datetime64[{unit}]'.format(unit=unit))
+	if isinstance(time, pd.Timestamp):
+		time = time.to_pydatetime()
+	if isinstance(time, datetime.datetime) and time.tzinfo is not None:
+		time = time.replace(tzinfo=None)
+	return np.datetime64(time).astype('datetime64[{unit}]'.format(unit=unit))
+
+
+def to_ns(time):
+	return to_datetime64(time, unit='ns').astype(np.int64)
+
+
+def ns_to_datetime(time):
+	return np.int64(time).astype('datetime64[ns]').astype('datetime64[us]').item()
+
+
+class TimeIndex:
+
+	# Sorted int64 nanosecond timestamps with a cursor that remembers the last lookup.
+	# Since the backtest clock only moves forward, most lookups are a few steps from the cursor.
+	def __init__(self, index):
+		if isinstance(index, pd.DatetimeIndex):
+			index = index.values
+		self.times = np.asarray(index).astype('datetime64[ns]').view(np.int64)
+		self.pos = 0
+
+
+	def __len__(self):
+		return len(self.times)
+
+
+	def seek(self, time, side='left'):
+		# side='left': position of the first time >= time, side='right': position of the first time > time
+		if not isinstance(time, (int, np.integer)):
+			time = to_ns(time)
+		times = self.times
+		pos = self.pos
+		if pos > 0 and (times[pos-1] >= time if side == 'left' else times[pos-1] > time):
+			pos = np.searchsorted(times, time, side=side)
+		else:
+			steps = 0
+			while pos < len(times) and (times[pos] < time if side == 'left' else times[pos] <= time):
+				pos += 1
+				steps += 1
+				if steps == 8:
+					pos = pos + np.searchsorted(times[pos:], time, side=side)
+					break
+		self.pos = int(pos)
+		return self.pos
 
 
 def is_trading_day(date):
-	date_range = nyse.schedule(start_date=date, end_date=date)
-	return len(date_range) > 0
+	return get_calendar(date).is_trading_day(date)
 
 
 def trading_day_offset(day, offset):
 	if isinstance(day, pd.Timestamp):
 		day = day.to_pydatetime()
-	if offset < 0:
-		roughstart = day - datetime.timedelta(days=2*abs(offset)+5)
-		cal = nyse.schedule(start_date=roughstart, end_date=day)
-		return cal.index[offset-1].to_pydatetime()
-	else:
-		roughend = day + datetime.timedelta(days=2*abs(offset)+5)
-		cal = nyse.schedule(start_date=day, end_date=roughend)
-		return cal.index[offset].to_pydatetime()
+	roughday = day + datetime.timedelta(days=(2*abs(offset)+5) * (1 if offset >= 0 else -1))
+	return get_calendar(min(day, roughday), max(day, roughday)).offset(day, offset)
 
 
 def next_runtime(trigger, time):
 	time += datetime.timedelta(seconds=1)
 	nexttime = trigger.get_next_fire_time(None, time).replace(tzinfo=None)
-	while not is_trading_day(nexttime):
-		nextday = (nexttime + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+	calendar = get_calendar(nexttime)
+	while not calendar.is_trading_day(nexttime):
+		nextday = datetime.datetime.combine(calendar.next_trading_day(nexttime), datetime.time())
 		nexttime = trigger.get_next_fire_time(None, nextday).replace(tzinfo=None)
+		calendar = get_calendar(nexttime)
 	return nexttime
 
 
@@ -42,10 +155,14 @@ def equals_runtime(trigger, time):
 	return time == trigger.get_next_fire_time(None, time.replace(tzinfo=None)).replace(tzinfo=None)
 
 
-def get_creds(key):
-	with open('creds.json') as f:
-		creds = json.load(f)
-	return creds[key]
+creds_cache = {}
+
+def get_creds(key, path='creds.json'):
+	# creds.json is only read once
+	if path not in creds_cache:
+		with open(path) as f:
+			creds_cache[path] = json.load(f)
+	return creds_cache[path][key]
 
 
 def convert_trigger_timezone(trigger, timezone):
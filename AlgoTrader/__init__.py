@@ -1,7 +1,24 @@
 from AlgoTrader.AlpacaData import *
 from AlgoTrader.Broker import *
+from AlgoTrader.Clients import *
 from AlgoTrader.Logger import *
 from AlgoTrader.Util import *
 from AlgoTrader.Algo import *
+from AlgoTrader.Indicators import *
 from AlgoTrader.Manager import *
-from AlgoTrader.MarketDataSet import *
\ No newline at end of file
+
+
+# MarketDataSet needs torch, so it is only imported the first time it is used
+lazy_imports = {'MarketDataSet': 'AlgoTrader.MarketDataSet', 'MappedMarketDataSet': 'AlgoTrader.MarketDataSet', 'export_dataset': 'AlgoTrader.MarketDataSet', 'WindowBatchSampler': 'AlgoTrader.MarketDataSet', 'collate_fn': 'AlgoTrader.MarketDataSet'}
+
+def __getattr__(name):
+	if name in lazy_imports:
+		import importlib
+		value = getattr(importlib.import_module(lazy_imports[name]), name)
+		globals()[name] = value
+		return value
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# from AlgoTrader import * exports the lazy names too (which imports them), as the star import of MarketDataSet used to
+__all__ = [name for name in globals() if not name.startswith('_') and name != 'lazy_imports'] + list(lazy_imports)
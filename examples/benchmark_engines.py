@@ -0,0 +1,25 @@
+from AlgoTrader.Manager import Manager
+from AlgoTrader.AlpacaData import AlpacaData
+from macd import MACDstrategy
+import datetime
+import time
+
+
+def benchmark(data, engine, start, end):
+	manager = Manager(data)
+	manager.add_algo(MACDstrategy())
+	manager.logger.report = lambda *args, **kwargs: None
+	t0 = time.perf_counter()
+	metrics = manager.backtest(start=start, end=end, engine=engine)
+	return time.perf_counter() - t0, metrics
+
+
+if __name__ == '__main__':
+	start_date = datetime.datetime(2016,1,1)
+	end_date = datetime.datetime(2021,8,20)
+	data = AlpacaData(start=start_date-datetime.timedelta(days=100), end=end_date, symbols=["SPY"], news_data=False)
+	results = {}
+	for engine in ['schedule', 'event']:
+		results[engine] = benchmark(data, engine, start_date, end_date)
+	for engine, (duration, metrics) in results.items():
+		print("{engine}: {duration:.2f}s, total return {ret:.3f}".format(engine=engine, duration=duration, ret=metrics['total return']))
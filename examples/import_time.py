@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import json
+
+# Checks that "import AlgoTrader" stays fast: it has to finish within the time budget (in seconds, the first
+# argument) and must not pull in the heavy optional dependencies, which are only imported on first use.
+# Exits with status 1 if either check fails, so it can be run in CI.
+
+heavy_modules = ['torch', 'transformers', 'quantstats', 'pandas_market_calendars']
+
+script = """
+import json, sys, time
+t0 = time.perf_counter()
+import AlgoTrader
+duration = time.perf_counter() - t0
+print(json.dumps({'duration': duration, 'modules': sorted(sys.modules)}))
+"""
+
+
+def measure(repeat=3):
+	# Each import runs in a fresh interpreter, and the fastest run is kept to filter out disk cache effects
+	results = []
+	for _ in range(repeat):
+		output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+		results.append(json.loads(output.strip().splitlines()[-1]))
+	return min(results, key=lambda result: result['duration'])
+
+
+if __name__ == '__main__':
+	budget = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+	result = measure()
+	loaded = [module for module in heavy_modules if module in result['modules']]
+	print("import AlgoTrader: {duration:.2f}s (budget {budget:.2f}s)".format(duration=result['duration'], budget=budget))
+	failed = False
+	if result['duration'] > budget:
+		print("Import took longer than the budget")
+		failed = True
+	if len(loaded) > 0:
+		print("Imported heavy modules at import time: {modules}".format(modules=", ".join(loaded)))
+		failed = True
+	sys.exit(1 if failed else 0)
@@ -1,17 +1,18 @@
 from AlgoTrader.Algo import Algo
 from AlgoTrader.Manager import Manager
 from AlgoTrader.AlpacaData import AlpacaData
-import ta
+from AlgoTrader.Indicators import MACD
 import datetime
 
 class MACDstrategy(Algo):
 
-	def init(self):
+	def init(self, fast=12, slow=26, signal=9):
+		# fast, slow and signal are the MACD windows, so they can be swept with manager.sweep
 		self.set_schedule({"second": 5, "minute": 30, "hour": 13, "day_of_week": "mon-fri"})
+		self.macd = self.add_indicator(MACD(window_slow=slow, window_fast=fast, window_sign=signal), "SPY", datatype="open")
 
 	def run(self):
-		hist = self.get_data("SPY", datatype="open", length=50)
-		macd = ta.trend.macd_diff(hist, window_slow=26, window_fast=12, window_sign=9)[-1]
+		macd = self.macd.value
 		if macd > 0:
 			self.order_target_percent("SPY", 1.0)
 		else:
@@ -6,7 +6,7 @@ import datetime
 import math
 import webbrowser
 from AlgoTrader.AlpacaData import AlpacaData
-from AlgoTrader.MarketDataSet import MarketDataSet, collate_fn
+from AlgoTrader.MarketDataSet import MarketDataSet, WindowBatchSampler, collate_fn
 from Model import MarketPredictor, create_indicators, percent_change, loss_fn, stats
 
 
@@ -42,9 +42,9 @@ if __name__ == '__main__':
 
 	alpacadata = AlpacaData(symbols=["SPY"], timeframe='day', start=3000, end=datetime.datetime(2017,1,1))
 	dataset = MarketDataSet(alpacadata, hist=length, datatypes=['open'])
-	train_dataset, val_dataset = torch.utils.data.random_split(dataset, [len(dataset)-300, 300])
-	train_dataloader = DataLoader(train_dataset, batch_size=32, shuffle=True, collate_fn=collate_fn)
-	val_dataloader = DataLoader(val_dataset, batch_size=32, shuffle=True, collate_fn=collate_fn)
+	indices = torch.randperm(len(dataset))
+	train_dataloader = DataLoader(dataset, batch_sampler=WindowBatchSampler(indices[300:], batch_size=32, shuffle=True), collate_fn=collate_fn)
+	val_dataloader = DataLoader(dataset, batch_sampler=WindowBatchSampler(indices[:300], batch_size=32, shuffle=True), collate_fn=collate_fn)
 
 	tensorboard = SummaryWriter()
 	tb = program.TensorBoard()